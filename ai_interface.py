@@ -1,12 +1,416 @@
 # ai_interface.py
 
+import hashlib
+import json
+import logging
+import os
 import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from http import HTTPStatus
-import dashscope
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
 
-dashscope.api_key = "sk-95ddb5205f614d35aeb98c0ca4f2f8f2"
+logger = logging.getLogger(__name__)
 
-def call_with_messages(content, report_style='formal'):
+DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY", "sk-95ddb5205f614d35aeb98c0ca4f2f8f2")
+# 可指向本地的模拟服务进行测试
+DASHSCOPE_BASE_URL = os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/api/v1")
+GENERATION_PATH = "/services/aigc/text-generation/generation"
+
+# 并发调用的上限和单次调用的超时时间（秒），可通过环境变量调整
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "6"))
+AI_CALL_TIMEOUT = float(os.getenv("AI_CALL_TIMEOUT", "90"))
+
+# 失败重试次数、退避时间（秒）和熔断参数
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "3"))
+AI_BACKOFF_BASE = float(os.getenv("AI_BACKOFF_BASE", "1"))
+AI_BACKOFF_MAX = float(os.getenv("AI_BACKOFF_MAX", "10"))
+AI_BREAKER_THRESHOLD = int(os.getenv("AI_BREAKER_THRESHOLD", "5"))
+AI_BREAKER_RESET = float(os.getenv("AI_BREAKER_RESET", "60"))
+AI_POOL_SIZE = int(os.getenv("AI_POOL_SIZE", "10"))
+AI_CONNECT_TIMEOUT = 5
+
+TIMEOUT_MESSAGE = "抱歉，分析超时。请稍后再试。"
+ERROR_MESSAGE = "抱歉，无法完成分析。请稍后再试。"
+EXCEPTION_MESSAGE = "抱歉，处理您的请求时出错。请稍后再试。"
+UNAVAILABLE_MESSAGE = "（AI 分析服务暂时不可用，该部分内容待稍后补充。）"
+# 以上任意一条出现在报告中，都表示该部分需要稍后重新生成
+FAILURE_MESSAGES = (TIMEOUT_MESSAGE, ERROR_MESSAGE, EXCEPTION_MESSAGE, UNAVAILABLE_MESSAGE)
+
+MODEL_NAME = "qwen-turbo"
+
+# AI 后端：dashscope（默认）或 local（本地模拟，用于压测和离线测试）
+AI_BACKEND = os.getenv("AI_BACKEND", "dashscope")
+# 本地模拟后端每次调用的延迟（秒）、回复字数和可选的预设回复文件（JSON，关键词 -> 回复）
+AI_LOCAL_LATENCY = float(os.getenv("AI_LOCAL_LATENCY", "0"))
+AI_LOCAL_RESPONSE_CHARS = int(os.getenv("AI_LOCAL_RESPONSE_CHARS", "400"))
+AI_LOCAL_RESPONSES = os.getenv("AI_LOCAL_RESPONSES")
+
+# AI 分析结果缓存的位置、有效期（秒）和最大条目数
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", os.path.join("instance", "ai_cache.db"))
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", str(7 * 24 * 3600)))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "5000"))
+# 命中/未命中计数保存在 Redis 的这个哈希中，web 进程和 worker 共用
+AI_CACHE_COUNTERS_KEY = "ai_cache:counters"
+
+
+class AnalysisCache:
+    """
+    基于 SQLite 的 AI 分析结果缓存，按内容哈希索引，支持 TTL 过期和 LRU 淘汰。
+
+    参数：
+    - path: 数据库文件路径
+    - ttl: 条目有效期（秒）
+    - max_entries: 最多保留的条目数，超出时淘汰最久未访问的条目
+    - redis_url: 保存命中/未命中计数的 Redis 地址，为空时计数保存在本地数据库中（仅用于本地开发）
+
+    缓存条目保存在各进程所在机器的本地数据库中，只有生成报告的 worker 会读写；
+    计数保存在 Redis 中，因此 web 进程的统计接口能看到 worker 的命中情况。
+    """
+
+    def __init__(self, path, ttl, max_entries, redis_url=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.redis_url = redis_url
+        self._lock = threading.Lock()
+        self._conn = None
+        self._redis = None
+
+    def _client(self):
+        if not self.redis_url:
+            return None
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(self.redis_url)
+        return self._redis
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS ai_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS ai_cache_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(model, report_style, content):
+        """
+        由模型、风格和提示词生成缓存键。提示词中的空白会先归一化。
+        """
+        normalized = " ".join(content.split())
+        payload = json.dumps([model, report_style, normalized], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created_at FROM ai_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM ai_cache WHERE key = ?", (key,))
+                row = None
+            elif row is not None:
+                conn.execute("UPDATE ai_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+        self._increment("misses" if row is None else "hits")
+        return row[0] if row is not None else None
+
+    def _increment(self, name, amount=1):
+        client = self._client()
+        if client is None:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT INTO ai_cache_counters (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    (name, amount),
+                )
+                conn.commit()
+            return
+        client.hincrby(AI_CACHE_COUNTERS_KEY, name, amount)
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO ai_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            conn.execute("DELETE FROM ai_cache WHERE created_at < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM ai_cache WHERE key NOT IN "
+                "(SELECT key FROM ai_cache ORDER BY accessed_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            conn.commit()
+            entries = conn.execute("SELECT COUNT(*) FROM ai_cache").fetchone()[0]
+        client = self._client()
+        if client is not None:
+            # 条目数由写入缓存的 worker 上报，统计接口不必访问 worker 的磁盘
+            client.hset(AI_CACHE_COUNTERS_KEY, "entries", entries)
+
+    def stats(self):
+        """
+        返回缓存命中/未命中次数和条目数。配置了 Redis 时为所有进程的合计，
+        条目数为最近一次写入缓存的 worker 上的条目数。
+        """
+        client = self._client()
+        if client is not None:
+            counters = {name.decode(): int(value) for name, value in client.hgetall(AI_CACHE_COUNTERS_KEY).items()}
+        else:
+            with self._lock:
+                conn = self._connect()
+                counters = dict(conn.execute("SELECT name, value FROM ai_cache_counters").fetchall())
+                counters["entries"] = conn.execute("SELECT COUNT(*) FROM ai_cache").fetchone()[0]
+        return {name: counters.get(name, 0) for name in ("hits", "misses", "entries")}
+
+
+analysis_cache = AnalysisCache(AI_CACHE_PATH, AI_CACHE_TTL, AI_CACHE_MAX_ENTRIES, os.getenv("REDISCLOUD_URL"))
+
+class AIRequestError(Exception):
+    """
+    AI 接口返回错误或请求失败。
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(AIRequestError):
+    """
+    熔断器处于打开状态，请求未发出。
+    """
+
+
+class CircuitBreaker:
+    """
+    连续失败达到 failure_threshold 次后打开，reset_timeout 秒内的请求直接失败；
+    之后放行一个试探请求（半开），成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_progress:
+                return False
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_progress or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class DashScopeClient:
+    """
+    DashScope 文本生成接口的客户端：共享 HTTP 连接池，每次调用有总的截止时间，
+    遇到 429/5xx 或网络错误时按带抖动的指数退避重试，并通过熔断器在上游故障时快速失败。
+    """
+
+    model = MODEL_NAME
+
+    def __init__(self, api_key, base_url, pool_size=AI_POOL_SIZE, max_retries=AI_MAX_RETRIES,
+                 backoff_base=AI_BACKOFF_BASE, backoff_max=AI_BACKOFF_MAX, breaker=None):
+        self.api_key = api_key
+        self.url = base_url.rstrip("/") + GENERATION_PATH
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker(AI_BREAKER_THRESHOLD, AI_BREAKER_RESET)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def _is_retryable(status_code):
+        return status_code == HTTPStatus.TOO_MANY_REQUESTS or status_code >= 500
+
+    def generate(self, model, messages, timeout, on_partial=None):
+        """
+        生成文本并返回。提供 on_partial 时使用流式输出。
+        失败时抛出 AIRequestError，熔断器打开时抛出 CircuitOpenError。
+        """
+        deadline = time.monotonic() + timeout
+        payload = {
+            "model": model,
+            "input": {"messages": messages},
+            "parameters": {"result_format": "message", "seed": random.randint(1, 10000)},
+        }
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if on_partial is not None:
+            payload["parameters"]["incremental_output"] = True
+            headers["X-DashScope-SSE"] = "enable"
+            headers["Accept"] = "text/event-stream"
+
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError("AI 服务熔断中")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                response = self.session.post(
+                    self.url, json=payload, headers=headers,
+                    timeout=(min(AI_CONNECT_TIMEOUT, remaining), remaining),
+                    stream=on_partial is not None
+                )
+                with response:
+                    if response.status_code == HTTPStatus.OK:
+                        if on_partial is not None:
+                            result = self._read_stream(response, on_partial, deadline)
+                        else:
+                            result = response.json()["output"]["choices"][0]["message"]["content"]
+                        self.breaker.record_success()
+                        return result
+                    last_error = AIRequestError(
+                        f"请求失败: 状态码: {response.status_code}, 错误信息: {response.text[:200]}",
+                        response.status_code
+                    )
+            except requests.RequestException as e:
+                last_error = AIRequestError(f"网络错误: {e}")
+            except AIRequestError as e:
+                # 流式输出中途返回的错误或超过截止时间
+                last_error = e
+            except (ValueError, LookupError, TypeError) as e:
+                last_error = AIRequestError(f"无法解析响应: {e}")
+            if last_error.status_code is not None and not self._is_retryable(last_error.status_code):
+                # 4xx 属于请求本身的问题（例如某个提示词未通过内容审核），说明上游可用：
+                # 不重试也不计入熔断，半开状态下的试探请求按成功处理，熔断器不会停留在半开状态
+                self.breaker.record_success()
+                raise last_error
+            # 429/5xx、网络错误和无法解析的响应计入熔断，试探请求失败时熔断器重新打开
+            self.breaker.record_failure()
+            if attempt < self.max_retries:
+                time.sleep(max(0, min(self._backoff(attempt), deadline - time.monotonic())))
+        raise last_error or AIRequestError("请求超时")
+
+    @staticmethod
+    def _read_stream(response, on_partial, deadline):
+        # requests 的超时只限制每次读取的等待时间，持续输出的流需要在这里检查总的截止时间
+        chunks = []
+        for line in response.iter_lines(decode_unicode=True):
+            if time.monotonic() > deadline:
+                raise AIRequestError("请求超时")
+            if not line or not line.startswith("data:"):
+                continue
+            data = json.loads(line[len("data:"):])
+            if "output" not in data:
+                raise AIRequestError(f"请求失败: {data.get('code')}, 错误信息: {data.get('message')}")
+            chunks.append(data["output"]["choices"][0]["message"]["content"])
+            on_partial("".join(chunks))
+        return "".join(chunks)
+
+
+class LocalBackend:
+    """
+    本地模拟后端：不访问网络，按提示词确定性地返回预设或模板生成的文本，并模拟指定的延迟。
+    接口与 DashScopeClient.generate 相同。
+
+    参数：
+    - latency: 每次调用的总延迟（秒），流式输出时平均分摊到各段文本
+    - response_chars: 模板回复的字数
+    - responses: 可选的 {关键词: 回复} 字典，提示词包含关键词时返回对应回复
+    """
+
+    model = "local-stub"
+
+    def __init__(self, latency=AI_LOCAL_LATENCY, response_chars=AI_LOCAL_RESPONSE_CHARS, responses=None):
+        self.latency = latency
+        self.response_chars = response_chars
+        self.responses = responses or {}
+
+    def _respond(self, prompt):
+        for keyword, response in self.responses.items():
+            if keyword in prompt:
+                return response
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        sentence = "本部分为本地模拟生成的分析内容，用于测试报告生成流程。"
+        body = (sentence * (self.response_chars // len(sentence) + 1))[:self.response_chars]
+        return f"【模拟分析 {digest}】{body}"
+
+    def generate(self, model, messages, timeout, on_partial=None):
+        text = self._respond(messages[-1]["content"])
+        if on_partial is None:
+            time.sleep(min(self.latency, timeout))
+            return text
+        chunks = [text[i:i + 20] for i in range(0, len(text), 20)]
+        for i in range(len(chunks)):
+            time.sleep(min(self.latency / len(chunks), timeout))
+            on_partial("".join(chunks[:i + 1]))
+        return text
+
+
+def create_backend(name=AI_BACKEND):
+    """
+    按名称创建 AI 后端（dashscope 或 local）。
+    """
+    if name == "local":
+        responses = None
+        if AI_LOCAL_RESPONSES:
+            with open(AI_LOCAL_RESPONSES, encoding="utf-8") as responses_file:
+                responses = json.load(responses_file)
+        return LocalBackend(responses=responses)
+    if name == "dashscope":
+        return DashScopeClient(DASHSCOPE_API_KEY, DASHSCOPE_BASE_URL)
+    raise ValueError(f"未知的 AI 后端: {name}")
+
+
+ai_backend = create_backend()
+
+def call_with_messages(content, report_style='formal', use_cache=True, on_partial=None, timeout=None):
+    """
+    调用大模型生成分析文本。timeout 为本次调用的总时间上限（秒），默认 AI_CALL_TIMEOUT。
+
+    相同模型、风格和提示词的结果会被缓存，use_cache=False 时跳过缓存强制重新生成
+    （新结果仍会写入缓存）。提供 on_partial(text) 回调时使用流式输出，生成过程中
+    不断以已生成的文本调用该回调。
+    """
     # 根据 report_style 为内容添加不同风格的提示
     style_prompt = {
         "formal": "使用详略得当的语言",
@@ -16,6 +420,20 @@ def call_with_messages(content, report_style='formal'):
     
     # 获取用户选择的风格提示，默认为正式风格
     style_instruction = style_prompt.get(report_style, "请使用正式且专业的语言撰写报告内容。")
+
+    model = getattr(ai_backend, "model", MODEL_NAME)
+    cache_key = AnalysisCache.make_key(model, report_style, content)
+    if use_cache:
+        # 缓存只是优化，读取失败时按未命中处理
+        try:
+            cached = analysis_cache.get(cache_key)
+        except Exception as e:
+            logger.warning("无法读取 AI 分析缓存: %s", e)
+            cached = None
+        if cached is not None:
+            if on_partial is not None:
+                on_partial(cached)
+            return cached
     
     # 将风格提示添加到消息内容
     messages = [
@@ -23,21 +441,75 @@ def call_with_messages(content, report_style='formal'):
     ]
     
     try:
-        response = dashscope.Generation.call(
-            model="qwen-turbo",
-            messages=messages,
-            seed=random.randint(1, 10000),
-            result_format='message'
-        )
-        if response.status_code == HTTPStatus.OK:
-            return response['output']['choices'][0]['message']['content']
-        
-        error_message = (
-            f'请求失败: {response.request_id}, 状态码: {response.status_code}, '
-            f'错误代码: {response.code}, 错误信息: {response.message}'
-        )
-        print(error_message)
-        return "抱歉，无法完成分析。请稍后再试。"
+        result = ai_backend.generate(model, messages, timeout or AI_CALL_TIMEOUT, on_partial)
+    except CircuitOpenError:
+        return UNAVAILABLE_MESSAGE
+    except AIRequestError as e:
+        logger.warning("AI 请求失败: %s", e)
+        return ERROR_MESSAGE
+    except Exception:
+        logger.exception("AI 分析出错")
+        return EXCEPTION_MESSAGE
+    # 写入缓存失败不影响已生成的结果
+    try:
+        analysis_cache.set(cache_key, result)
     except Exception as e:
-        print(f"发生错误: {str(e)}")
-        return "抱歉，处理您的请求时出错。请稍后再试。"
+        logger.warning("无法写入 AI 分析缓存: %s", e)
+    return result
+
+def call_many(prompts, max_workers=None, timeout=None, use_cache=True, on_result=None, on_partial=None,
+              job_id=None, section_names=None):
+    """
+    并发调用 call_with_messages，结果按 prompts 的顺序返回。
+
+    参数：
+    - prompts: (content, report_style) 元组列表
+    - max_workers: 同时进行的请求数上限，默认 AI_MAX_CONCURRENCY
+    - timeout: 全部请求共用的截止时间（秒），默认 AI_CALL_TIMEOUT；到期仍未完成的请求返回 TIMEOUT_MESSAGE
+    - use_cache: 是否使用 AI 分析结果缓存
+    - on_result: 可选回调 on_result(index, result)，按顺序每取得一个结果调用一次，用于报告进度
+    - on_partial: 可选回调 on_partial(index, text)，提供时使用流式输出，在工作线程中随生成进度调用
+    - job_id, section_names: 用于每次调用的计时日志
+
+    超时的请求不会被强行中断，但每个请求只获得截止前剩余的时间作为自己的超时，
+    因此后台线程最迟在截止时间之后一个网络读取周期内结束，不会无限占用连接。
+    """
+    if not prompts:
+        return []
+    max_workers = max_workers or AI_MAX_CONCURRENCY
+    timeout = timeout or AI_CALL_TIMEOUT
+    deadline = time.monotonic() + timeout
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(prompts)))
+    try:
+        def timed_call(index, content, report_style):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return TIMEOUT_MESSAGE
+            section = section_names[index] if section_names else str(index)
+            with metrics.span("ai", job_id, section=section):
+                return call_with_messages(
+                    content, report_style, use_cache,
+                    (lambda text: on_partial(index, text)) if on_partial is not None else None,
+                    timeout=remaining
+                )
+
+        futures = [
+            executor.submit(timed_call, index, content, report_style)
+            for index, (content, report_style) in enumerate(prompts)
+        ]
+        results = []
+        for future in futures:
+            # 所有请求共用一个截止时间，总耗时不超过 timeout
+            try:
+                results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+            except FutureTimeoutError:
+                future.cancel()
+                logger.warning("AI 请求超时（%s 秒）", timeout)
+                results.append(TIMEOUT_MESSAGE)
+            if on_result is not None:
+                on_result(len(results) - 1, results[-1])
+        return results
+    finally:
+        # 不等待超时的请求结束，避免拖慢报告生成；它们的超时不超过截止时间（见 timed_call）
+        executor.shutdown(wait=False, cancel_futures=True)
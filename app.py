@@ -1,20 +1,28 @@
 import os
-import time  # Optional delay for troubleshooting
+import json
+import time
 import logging
-from flask import Flask, render_template, request, redirect, url_for, send_file, jsonify, session
-from werkzeug.utils import secure_filename
-from data_processing import run_report_generation
+from flask import Flask, Response, render_template, request, redirect, url_for, send_file, jsonify, session, stream_with_context
+from data_processing import generate_report_task
 from models import db, User
 from flask_sqlalchemy import SQLAlchemy
 from celery import Celery
-from report_generation import generate_report_task  # 确保任务导入正确
+from ai_interface import analysis_cache
+from batch_processing import save_batch_uploads, start_batch, BatchUploadError, BATCH_ZIP_NAME
+from metrics import render_prometheus
+from report_cache import report_cache, make_key
+from blob_store import report_store, fetch, key_digest, GENERATED_REPORTS_DIR
+from storage import save_upload, touch_artifact, storage_index, STORAGE_SWEEP_INTERVAL
+import jobs
+from jobs import job_registry
+from score_store import load_stats, aggregate_stats
 
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['GENERATED_REPORTS'] = 'generated_reports'
+app.config['GENERATED_REPORTS'] = GENERATED_REPORTS_DIR
 
 # Configure SQLAlchemy with PostgreSQL
 uri = os.getenv('DATABASE_URL')
@@ -31,7 +39,11 @@ def make_celery(app):
         broker=os.getenv("REDISCLOUD_URL")
     )
     celery.conf.update(app.config)
-    celery.conf.imports = ["report_generation"]  # 添加 Celery 任务的导入路径
+    celery.conf.imports = ["data_processing", "batch_processing", "storage"]  # 添加 Celery 任务的导入路径
+    # worker 以 --beat 启动时定时清理过期的上传文件和报告
+    celery.conf.beat_schedule = {
+        "sweep-storage": {"task": "storage.sweep_storage_task", "schedule": STORAGE_SWEEP_INTERVAL},
+    }
     return celery
 
 # Update the Celery configuration in app.py
@@ -42,6 +54,9 @@ app.config.update(
 
 celery = make_celery(app)
 
+# SSE 连接在没有进度变化时发送心跳的间隔（秒）
+SSE_KEEPALIVE_SECONDS = 15
+
 
 db.init_app(app)
 
@@ -67,48 +82,198 @@ def process_file():
     if file.filename == '':
         return redirect(url_for('index'))
 
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
-
     class_name1 = request.form.get('class_name1', '')
     class_name2 = request.form.get('class_name2', '')
     report_style = session.get('report_style', 'formal')
-
-    session_id = os.urandom(8).hex()
-    session[session_id] = {"progress": 0, "status": "Initializing"}
-
-    task = generate_report_task.delay(file_path, class_name1, class_name2, session_id, report_style)
-    session[session_id]["task_id"] = task.id
+    # 勾选"重新生成"时跳过 AI 分析缓存和报告缓存
+    use_cache = request.form.get('force_regenerate') != 'on'
+    # 勾选"分班级统计"时按班级（行政班或工作表）分别统计，报告中附上各班级的对比
+    group_by_class = request.form.get('group_by_class') == 'on'
+    # 多工作表的工作簿：合并为一份报告（merged），或每个工作表一份报告（per_sheet，打包下载）
+    per_sheet = request.form.get('sheet_mode') == 'per_sheet'
+
+    # 任务 ID 出现在进度和下载地址中，任务状态保存在服务端的任务登记表里
+    job_id = os.urandom(16).hex()
+
+    # 上传的文件分块写入共享存储（以内容哈希命名），任务只接收存储键
+    original_name = os.path.basename(file.filename.replace("\\", "/"))
+    blob_key = save_upload(file.stream, os.path.splitext(original_name)[1].lower())
+
+    if per_sheet:
+        # 工作表的数量在 worker 中读取工作簿后才知道，批次的总数由 sheet_reports_task 填写
+        job_registry.create(job_id, batch=True, file=original_name)
+        task = start_batch(job_id, [(original_name, blob_key)], class_name1, class_name2, report_style, use_cache, group_by_class, per_sheet=True)
+        job_registry.update(job_id, task_id=task.id)
+        return jsonify({"status": "processing", "session_id": job_id})
+
+    # 同一份成绩表以相同参数生成过报告时直接返回，不再排队
+    cache_key = make_key(key_digest(blob_key), class_name1, class_name2, report_style, group_by_class)
+    cached = report_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        report_key, report_name, warning = cached
+        job_registry.create(
+            job_id, status=jobs.COMPLETED, progress=100, report_key=report_key, report_name=report_name, warning=warning
+        )
+        return jsonify({"session_id": job_id, **progress_payload(job_id)})
+
+    job_registry.create(job_id, file=original_name)
+    task = generate_report_task.delay(blob_key, original_name, class_name1, class_name2, job_id, report_style, use_cache=use_cache, cache_key=cache_key, group_by_class=group_by_class)
+    job_registry.update(job_id, task_id=task.id)
     
-    return jsonify({"status": "processing", "session_id": session_id})
+    return jsonify({"status": "processing", "session_id": job_id})
+
+# Batch upload: several .xlsx files and/or .zip archives, one report task per workbook
+@app.route('/process_batch', methods=['POST'])
+def process_batch():
+    files = request.files.getlist('files') or request.files.getlist('file')
+    files = [file for file in files if file.filename]
+    if not files:
+        return jsonify({"status": "fail", "message": "未选择文件"}), 400
+
+    job_id = os.urandom(16).hex()
+    try:
+        workbooks = save_batch_uploads(files)
+    except BatchUploadError as e:
+        return jsonify({"status": "fail", "message": str(e)}), 400
+    if not workbooks:
+        return jsonify({"status": "fail", "message": "未找到 .xlsx 文件"}), 400
+
+    class_name1 = request.form.get('class_name1', '')
+    class_name2 = request.form.get('class_name2', '')
+    report_style = session.get('report_style', 'formal')
+    use_cache = request.form.get('force_regenerate') != 'on'
+    group_by_class = request.form.get('group_by_class') == 'on'
+    per_sheet = request.form.get('sheet_mode') == 'per_sheet'
+
+    job_registry.create(job_id, batch=True, total=None if per_sheet else len(workbooks))
+    task = start_batch(job_id, workbooks, class_name1, class_name2, report_style, use_cache, group_by_class, per_sheet)
+    job_registry.update(job_id, task_id=task.id)
+
+    return jsonify({"status": "processing", "session_id": job_id, "workbooks": len(workbooks)})
+
+def progress_payload(job_id):
+    """
+    从任务登记表读取任务状态，转换为返回给前端的进度信息。
+    """
+    job = job_registry.get(job_id)
+    if job is None:
+        return {"progress": 0, "status": jobs.FAILED, "message": "任务不存在或已过期"}
+    status = job.get("status", jobs.PENDING)
+    if status == jobs.COMPLETED:
+        endpoint = 'download_batch' if job.get("batch") else 'download_report'
+        return {"progress": 100, "status": status, "download_url": url_for(endpoint, session_id=job_id), "warning": job.get("warning")}
+    elif status == jobs.IN_PROGRESS:
+        return {"progress": job.get("progress", 0), "status": status, "message": job.get("message", ""), "preview": job.get("preview")}
+    elif status == jobs.FAILED:
+        return {"progress": 0, "status": status, "message": job.get("message", "")}
+    return {"progress": 0, "status": status}
 
 # Check progress of report generation
 @app.route('/progress/<session_id>')
 def check_progress(session_id):
-    task_id = session.get(session_id, {}).get("task_id")
-    task = celery.AsyncResult(task_id)
-    if task.state == "SUCCESS":
-        return jsonify({"progress": 100, "status": "completed", "download_url": url_for('download_report', session_id=session_id)})
-    elif task.state == "PENDING":
-        return jsonify({"progress": 0, "status": "pending"})
-    elif task.state == "PROGRESS":
-        return jsonify({"progress": task.info.get('progress', 0), "status": "in_progress"})
-    else:
-        return jsonify({"progress": 0, "status": "failed"})
+    return jsonify(progress_payload(session_id))
+
+# Stream progress updates (Server-Sent Events) instead of polling /progress
+@app.route('/progress/<session_id>/stream')
+def stream_progress(session_id):
+    def sse(payload):
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    def events():
+        # 任务登记表在每次更新时都会发布通知，订阅它即可在进度变化时推送
+        pubsub = job_registry.subscribe(session_id)
+        try:
+            payload = progress_payload(session_id)
+            yield sse(payload)
+            while payload["status"] not in (jobs.COMPLETED, jobs.FAILED):
+                if pubsub is not None:
+                    message = pubsub.get_message(ignore_subscribe_messages=True, timeout=SSE_KEEPALIVE_SECONDS)
+                    if message is None:
+                        yield ": keep-alive\n\n"
+                        continue
+                else:
+                    # 没有 Redis：在服务端轮询，只在进度变化时推送
+                    time.sleep(1)
+                new_payload = progress_payload(session_id)
+                if new_payload != payload:
+                    payload = new_payload
+                    yield sse(payload)
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=headers)
+
+def send_blob(key, download_name):
+    """
+    从共享存储取出文件并作为附件返回，文件不存在时返回 404。
+    """
+    try:
+        path = fetch(key, report_store)
+    except Exception as e:
+        logging.error("File not found in blob store: %s (%s)", key, e)
+        return "File not found", 404
+    touch_artifact(key)
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=download_name)
 
 # Download the generated report
 @app.route('/download/<session_id>')
 def download_report(session_id):
-    report_path = session.get(session_id, {}).get("report_path")
-    logging.info(f"Attempting to download report from: {report_path}")
-    time.sleep(0.5)
+    job = job_registry.get(session_id) or {}
+    report_key = job.get("report_key")
+    logging.info(f"Attempting to download report: {report_key}")
 
-    if report_path and os.path.isfile(report_path):
-        return send_file(report_path, as_attachment=True)
-    else:
-        logging.error("File not found at the specified path: %s", report_path)
+    if not report_key:
+        logging.error("No report available for job: %s", session_id)
+        return "File not found", 404
+    return send_blob(report_key, job.get("report_name"))
+
+# AI analysis cache hit/miss counters (shared by web and worker through Redis)
+@app.route('/ai_cache/stats')
+def ai_cache_stats():
+    return jsonify(analysis_cache.stats())
+
+# Download the zip of all reports in a batch
+@app.route('/download_batch/<session_id>')
+def download_batch(session_id):
+    zip_key = (job_registry.get(session_id) or {}).get("zip_key")
+
+    if not zip_key:
+        logging.error("Batch archive not found for job: %s", session_id)
         return "File not found", 404
+    return send_blob(zip_key, BATCH_ZIP_NAME)
+
+# Cached report count and size
+@app.route('/report_cache/stats')
+def report_cache_stats():
+    return jsonify(report_cache.stats())
+
+# Stored uploads and reports: file count and size
+@app.route('/storage/stats')
+def storage_stats():
+    return jsonify(storage_index.stats())
+
+# Cross-course statistics from the columnar score store, e.g.
+# /analytics/stats?course=大学信息技术&semester=2023-2024学年第2学期&group_by=course,semester,class_name
+ANALYTICS_GROUP_COLUMNS = ("course", "semester", "class_name", "dataset")
+
+@app.route('/analytics/stats')
+def analytics_stats():
+    group_by = [column for column in request.args.get('group_by', 'course,semester').split(',') if column]
+    if not set(group_by) <= set(ANALYTICS_GROUP_COLUMNS):
+        return jsonify({"status": "fail", "message": f"group_by 只能包含 {', '.join(ANALYTICS_GROUP_COLUMNS)}"}), 400
+    stats = load_stats(request.args.getlist('course') or None, request.args.getlist('semester') or None)
+    score_type = request.args.get('score_type')
+    if score_type:
+        stats = stats[stats["score_type"] == score_type]
+    summary = aggregate_stats(stats, group_by)
+    return Response(summary.to_json(orient="records", force_ascii=False), mimetype='application/json')
+
+# Prometheus metrics: per-stage report generation timings
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/register', methods=['POST'])
 def register():
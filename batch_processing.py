@@ -0,0 +1,184 @@
+# batch_processing.py
+
+import json
+import logging
+import os
+import tempfile
+import zipfile
+from celery import shared_task, chord
+from data_processing import generate_report_from_blob, list_sheet_names
+from blob_store import report_store, fetch
+from storage import save_upload, save_artifact
+import jobs
+from jobs import job_registry
+import metrics
+
+BATCH_ZIP_NAME = "成绩报告汇总.zip"
+MANIFEST_NAME = "manifest.json"
+# 一次批量上传中压缩包的成员总数和解压后的总字节数上限，防止压缩炸弹
+BATCH_ZIP_MAX_MEMBERS = int(os.getenv("BATCH_ZIP_MAX_MEMBERS", "500"))
+BATCH_ZIP_MAX_BYTES = int(os.getenv("BATCH_ZIP_MAX_BYTES", str(500 * 1024 * 1024)))
+
+
+class BatchUploadError(ValueError):
+    """
+    批量上传的压缩包超出成员数或解压大小的上限。
+    """
+
+def safe_workbook_name(name):
+    """
+    去掉上传文件名中的路径部分，保留中文等字符，只允许 .xlsx 文件。
+    返回 None 表示该文件应被忽略。
+    """
+    name = os.path.basename(name.replace("\\", "/")).strip()
+    if not name or name.startswith(".") or not name.lower().endswith(".xlsx"):
+        return None
+    return name
+
+def save_batch_uploads(files):
+    """
+    把批量上传的文件写入共享存储，.zip 文件会被解压，只保留其中的 .xlsx 工作簿。
+
+    参数：
+    - files: werkzeug FileStorage 列表
+
+    返回 (原始文件名, 存储键) 列表。压缩包的成员总数或解压后的总大小超过
+    BATCH_ZIP_MAX_MEMBERS / BATCH_ZIP_MAX_BYTES（超限的压缩包不会被解压）或压缩包损坏时
+    抛出 BatchUploadError。
+    """
+    workbooks = []
+    total_members = 0
+    total_bytes = 0
+    for file in files:
+        if file.filename.lower().endswith(".zip"):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = [
+                        member for member in archive.infolist()
+                        if not member.is_dir() and not member.filename.startswith("__MACOSX/")
+                        and safe_workbook_name(member.filename) is not None
+                    ]
+                    # 解压时 zipfile 最多读出 file_size 字节，所以按目录中的声明检查即可
+                    total_members += len(archive.infolist())
+                    total_bytes += sum(member.file_size for member in members)
+                    if total_members > BATCH_ZIP_MAX_MEMBERS:
+                        raise BatchUploadError(f"压缩包中的文件过多（上限 {BATCH_ZIP_MAX_MEMBERS} 个）")
+                    if total_bytes > BATCH_ZIP_MAX_BYTES:
+                        raise BatchUploadError(f"压缩包解压后过大（上限 {BATCH_ZIP_MAX_BYTES // (1024 * 1024)} MB）")
+                    for member in members:
+                        with archive.open(member) as source:
+                            workbooks.append((member.filename, save_upload(source, ".xlsx")))
+            except zipfile.BadZipFile as e:
+                # 目录中声明的大小与实际内容不符时，zipfile 在读到声明的大小后报错
+                raise BatchUploadError(f"无法解压压缩包: {file.filename}") from e
+        else:
+            name = safe_workbook_name(file.filename)
+            if name is None:
+                continue
+            workbooks.append((file.filename, save_upload(file.stream, ".xlsx")))
+    return workbooks
+
+@shared_task
+def workbook_report_task(batch_id, original_name, blob_key, class_name1, class_name2, report_style="formal", use_cache=True, group_by_class=False, sheet_name=None):
+    """
+    批量模式中单个工作簿（给出 sheet_name 时为其中一个工作表）的报告生成任务。出错时返回错误信息而不是抛出异常，
+    以免一个工作簿失败导致整个批次失败。完成后在批次的登记记录中累加完成数。
+    """
+    job_id = workbook_report_task.request.id
+    try:
+        with metrics.profiled(job_id), metrics.span("job", job_id, file=original_name):
+            result = generate_report_from_blob(
+                blob_key, original_name, class_name1, class_name2, session_id=job_id,
+                report_style=report_style, use_cache=use_cache, group_by_class=group_by_class, sheet_name=sheet_name,
+                progress_callback=lambda *args, **kwargs: None
+            )
+    except Exception as e:
+        logging.exception("批量报告生成失败: %s", original_name)
+        result = {"status": "error", "message": str(e)}
+    # 打包占最后 10%
+    batch = job_registry.get(batch_id) or {}
+    done = job_registry.increment(batch_id, "done")
+    total = batch.get("total") or done
+    job_registry.update(
+        batch_id, status=jobs.IN_PROGRESS, progress=int(90 * done / total),
+        message=f"已完成 {done}/{total} 份报告"
+    )
+    return {
+        "file": original_name if sheet_name is None else f"{original_name} [{sheet_name}]",
+        "status": result.get("status"),
+        "message": result.get("message", ""),
+        "report_key": result.get("report_key"),
+        "report_name": result.get("report_name"),
+        "pending_ai_sections": result.get("pending_ai_sections", []),
+        "coerced_scores": {column: count for column, count in result.get("coerced_scores", {}).items() if count},
+    }
+
+@shared_task
+def bundle_reports_task(results, batch_id):
+    """
+    将批次中所有生成成功的 .docx 报告和一份状态清单打包为一个 zip 文件，存入共享存储。
+    """
+    job_registry.update(batch_id, status=jobs.IN_PROGRESS, progress=90, message="正在打包报告...")
+    manifest = []
+    used_names = set()
+    with tempfile.TemporaryDirectory() as work_dir:
+        zip_path = os.path.join(work_dir, BATCH_ZIP_NAME)
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for result in results:
+                entry = {"file": result["file"], "status": result["status"], "message": result["message"]}
+                if result.get("pending_ai_sections"):
+                    entry["pending_ai_sections"] = result["pending_ai_sections"]
+                # 各成绩列中空白或非数字、按 0 分计算的成绩个数
+                if result.get("coerced_scores"):
+                    entry["coerced_scores"] = result["coerced_scores"]
+                if result["status"] == "success" and result.get("report_key"):
+                    arcname = result["report_name"]
+                    stem, ext = os.path.splitext(arcname)
+                    counter = 1
+                    while arcname in used_names:
+                        arcname = f"{stem}_{counter}{ext}"
+                        counter += 1
+                    used_names.add(arcname)
+                    archive.write(fetch(result["report_key"], report_store), arcname)
+                    entry["report"] = arcname
+                manifest.append(entry)
+            archive.writestr(MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2))
+        zip_key = save_artifact(zip_path)
+    succeeded = sum(1 for entry in manifest if entry["status"] == "success")
+    failed = len(manifest) - succeeded
+    job_registry.update(
+        batch_id, status=jobs.COMPLETED, progress=100, message=f"成功 {succeeded} 个，失败 {failed} 个",
+        zip_key=zip_key
+    )
+    return {"status": "success", "zip_key": zip_key, "succeeded": succeeded, "failed": failed}
+
+def _report_chord(batch_id, items, class_name1, class_name2, report_style, use_cache, group_by_class):
+    # items 为 (原始文件名, 存储键, 工作表名称或 None)，每项一个任务并行生成报告，全部完成后打包
+    header = [
+        workbook_report_task.s(batch_id, original_name, blob_key, class_name1, class_name2, report_style, use_cache, group_by_class, sheet_name)
+        for original_name, blob_key, sheet_name in items
+    ]
+    return chord(header)(bundle_reports_task.s(batch_id))
+
+@shared_task
+def sheet_reports_task(batch_id, workbooks, class_name1, class_name2, report_style="formal", use_cache=True, group_by_class=False):
+    """
+    每个工作表一份报告：在 worker 中列出各工作簿的工作表，再为每个工作表启动一个报告任务，
+    各工作表的解析和统计分散到 worker 池中并行进行，全部完成后打包。
+    """
+    items = []
+    for original_name, blob_key in workbooks:
+        for sheet_name in list_sheet_names(fetch(blob_key)):
+            items.append((original_name, blob_key, sheet_name))
+    job_registry.update(batch_id, total=len(items), message=f"共 {len(items)} 个工作表")
+    return _report_chord(batch_id, items, class_name1, class_name2, report_style, use_cache, group_by_class).id
+
+def start_batch(batch_id, workbooks, class_name1, class_name2, report_style="formal", use_cache=True, group_by_class=False, per_sheet=False):
+    """
+    每个工作簿一个任务并行生成报告（Celery chord），全部完成后打包；per_sheet 为 True 时改为每个工作表一份报告。
+    返回启动批次的任务的 AsyncResult。
+    """
+    if per_sheet:
+        return sheet_reports_task.delay(batch_id, workbooks, class_name1, class_name2, report_style, use_cache, group_by_class)
+    items = [(original_name, blob_key, None) for original_name, blob_key in workbooks]
+    return _report_chord(batch_id, items, class_name1, class_name2, report_style, use_cache, group_by_class)
@@ -0,0 +1,205 @@
+# benchmark.py
+"""
+报告生成流程的基准测试。
+
+生成与 run_report_generation 中两种列布局一致的合成成绩表（format_1 / format_2），
+分别计时读取、格式识别、清洗、统计、绘图、Word 生成以及端到端各阶段，并记录各阶段的
+峰值内存，结果以 JSON 输出，便于在不同提交之间比较。AI 调用使用本地模拟后端。
+
+用法：
+    python benchmark.py --sizes 50 500 5000 50000 --repeat 3 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# AI 调用使用本地模拟后端，缓存和增量生成记录写到临时目录，必须在导入项目模块之前设置
+os.environ["AI_BACKEND"] = "local"
+os.environ.setdefault("AI_LOCAL_LATENCY", "0")
+os.environ.setdefault("AI_CACHE_PATH", os.path.join(tempfile.gettempdir(), "benchmark_ai_cache.db"))
+os.environ.setdefault("SECTION_STORE_PATH", os.path.join(tempfile.gettempdir(), "benchmark_section_store.db"))
+
+import numpy as np
+from openpyxl import Workbook
+
+from data_processing import (
+    SCORE_FORMATS, SCORE_COLUMNS, read_sheet_grid, preview_from_grid, detect_format,
+    frame_from_grid, clean_score_frame, calculate_all_statistics, run_report_generation,
+)
+from plotting import render_distribution
+from report_generation import generate_word_report
+
+DEFAULT_SIZES = [50, 500, 5000, 50000]
+FORMATS = ["format_1", "format_2"]
+
+
+def write_synthetic_workbook(path, file_format, rows, seed=0):
+    """
+    生成一个合成成绩登记表。表头部分与学校导出的两种格式一致，成绩为随机数，
+    约 2% 的成绩单元格为空或为文字（如"缺考"），以覆盖清洗逻辑。
+    """
+    rng = np.random.default_rng(seed)
+    scores = rng.normal(75, 12, size=(rows, 4)).clip(0, 100).round(1)
+    missing = rng.random(size=(rows, 4)) < 0.02
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    if file_format == "format_1":
+        sheet.append(["厦门理工学院2023-2024学年第1学期成绩登记表"])
+        sheet.append(["开课部门：计算机与信息工程学院", None, None, "任课教师：测试", None, None, None, "考核方式：考查"])
+        sheet.append(["课程名称：大学信息技术", None, None, "课程代码：21900013", None, None, None, "学分：1.0"])
+        sheet.append(['序号', '姓名', '学号', None, '平时', '实验', '期末', '总评', '备注'])
+        sheet.append(["行政班：测试1班"])
+        for i in range(rows):
+            row_scores = ["缺考" if missing[i, j] else scores[i, j] for j in range(4)]
+            sheet.append([i + 1, f"学生{i + 1}", 2310000000 + i, None, *row_scores, None])
+    else:
+        sheet.append(["厦门理工学院学生成绩登记表"])
+        sheet.append(["(2023-2024学年第2学期)"])
+        sheet.append([None, "教学班", "21900013-大学信息技术-0001", "课程名称", "大学信息技术", None, "课程代号", "21900013"])
+        sheet.append([None, "上课教室", "实训机房", "上课时间", "星期二第1-2节"])
+        sheet.append(['编号', '学号', '姓名', '性别', '专业名称', '平时(20%)', '实验(20%)', '期末(60%)', '总评', '备注'])
+        for i in range(rows):
+            row_scores = [None if missing[i, j] else scores[i, j] for j in range(4)]
+            sheet.append([i + 1, 2310000000 + i, f"学生{i + 1}", "男", "测试专业", *row_scores, None])
+    workbook.save(path)
+
+
+def measure(func, repeat):
+    """
+    运行 func repeat 次计时，再在 tracemalloc 下运行一次记录峰值内存。返回 (统计信息, 最后一次的返回值)。
+    """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": statistics.median(durations),
+        "min_seconds": min(durations),
+        "peak_bytes": peak,
+    }, result
+
+
+def benchmark_workbook(path, work_dir, repeat):
+    stages = {}
+
+    stages["ingest"], grid = measure(lambda: read_sheet_grid(path), repeat)
+    stages["detect"], (file_format, start_row) = measure(
+        lambda: detect_format(preview_from_grid(grid)), repeat
+    )
+    spec = SCORE_FORMATS[file_format]
+    stages["clean"], (df_cleaned, _) = measure(
+        lambda: clean_score_frame(
+            frame_from_grid(grid, start_row + 1, spec["columns"], [spec["id_column"], *SCORE_COLUMNS]),
+            spec["id_column"], SCORE_COLUMNS
+        ),
+        repeat
+    )
+    stages["stats"], all_statistics = measure(lambda: calculate_all_statistics(df_cleaned, SCORE_COLUMNS), repeat)
+    stages["plots"], plot_images = measure(
+        lambda: [render_distribution(all_statistics[column][2], f"{column}成绩分布") for column in SCORE_COLUMNS],
+        repeat
+    )
+
+    all_scores_data = [
+        {
+            'score_type': column,
+            'stats': all_statistics[column][0],
+            'distribution_text': all_statistics[column][1],
+            'distribution_plot': all_statistics[column][2],
+            'plot_image': image,
+        }
+        for column, image in zip(SCORE_COLUMNS, plot_images)
+    ]
+    report_path = os.path.join(work_dir, "benchmark_report.docx")
+    stages["docx"], _ = measure(
+        lambda: generate_word_report(
+            "benchmark", report_path, all_scores_data, work_dir, "2023-2024学年第1学期", "大学信息技术",
+            len(df_cleaned), "测试1班", use_cache=False
+        ),
+        repeat
+    )
+    stages["end_to_end"], _ = measure(
+        lambda: run_report_generation(
+            path, "测试1班", "", None, use_cache=False, progress_callback=lambda *args, **kwargs: None
+        ),
+        repeat
+    )
+    return file_format, len(df_cleaned), stages
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="报告生成流程基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="合成成绩表的学生行数")
+    parser.add_argument("--formats", nargs="+", default=FORMATS, choices=FORMATS, help="成绩表格式")
+    parser.add_argument("--repeat", type=int, default=3, help="每个阶段的重复次数")
+    parser.add_argument("--output", help="JSON 结果文件，默认输出到标准输出")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for file_format in args.formats:
+            for rows in args.sizes:
+                path = os.path.join(work_dir, f"{file_format}_{rows}.xlsx")
+                write_synthetic_workbook(path, file_format, rows)
+                detected_format, students, stages = benchmark_workbook(path, work_dir, args.repeat)
+                results.append({
+                    "format": file_format,
+                    "detected_format": detected_format,
+                    "rows": rows,
+                    "students": students,
+                    "file_bytes": os.path.getsize(path),
+                    "stages": stages,
+                })
+                print(
+                    f"{file_format} {rows:>6} 行: "
+                    + ", ".join(f"{name} {stage['seconds']:.3f}s" for name, stage in stages.items()),
+                    file=sys.stderr
+                )
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# blob_store.py
+"""
+web 进程和 worker 进程共享的文件存储。
+
+web 进程与 worker 进程（见 Procfile）不共享磁盘，因此上传的成绩表和生成的报告都以
+内容哈希命名存入共享的存储中，任务之间只传递存储键。支持两种后端：
+
+- local：本地目录（默认），适合单机部署和测试；
+- s3：S3 兼容的对象存储（AWS S3、MinIO 等），需要安装 boto3，凭据使用 AWS 标准环境变量。
+
+上传的成绩表存入 blob_store，生成的报告和批量打包文件存入 report_store，两者的清理见 storage 模块。
+worker 通过 fetch() 读取文件，读取时经过本地的读穿透缓存，同一个文件只下载一次。
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+# 存储后端：local 或 s3
+BLOB_STORE = os.getenv("BLOB_STORE", "local")
+BLOB_LOCAL_DIR = os.getenv("BLOB_LOCAL_DIR", os.path.join("uploads", "blobs"))
+BLOB_S3_BUCKET = os.getenv("BLOB_S3_BUCKET")
+# 使用 MinIO 等 S3 兼容服务时设置，例如 http://localhost:9000
+BLOB_S3_ENDPOINT = os.getenv("BLOB_S3_ENDPOINT")
+BLOB_S3_PREFIX = os.getenv("BLOB_S3_PREFIX", "")
+# 生成的报告和打包文件单独存放：本地存储时在该目录下，S3 存储时在 reports/ 前缀下
+GENERATED_REPORTS_DIR = os.getenv("GENERATED_REPORTS", "generated_reports")
+
+# 读穿透缓存的目录和总大小上限（字节）
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "blob_cache"))
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+CHUNK_SIZE = 1024 * 1024
+# S3 上传前在内存中缓冲的最大字节数，超出时转存到临时文件
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+
+def key_digest(key):
+    """
+    从存储键中取出内容哈希（去掉扩展名）。
+    """
+    return os.path.splitext(key)[0]
+
+
+def _sharded_path(root, key):
+    # 按哈希前两位分目录，避免单个目录中文件过多
+    return os.path.join(root, key[:2], key)
+
+
+def _copy_hashing(source, target):
+    """
+    分块把 source 复制到 target，同时计算 SHA-256，返回十六进制摘要。
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+        target.write(chunk)
+    return digest.hexdigest()
+
+
+class LocalBlobStore:
+    """
+    以本地目录作为共享存储。
+
+    参数：
+    - root: 存储目录
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def put_stream(self, stream, suffix=""):
+        """
+        分块写入一个文件流，返回以内容哈希命名的存储键。内容相同的文件只保存一份。
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as temp_file:
+            digest = _copy_hashing(stream, temp_file)
+        key = f"{digest}{suffix}"
+        path = _sharded_path(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_file.name, path)
+        return key
+
+    def download(self, key, path):
+        shutil.copyfile(_sharded_path(self.root, key), path)
+
+    def local_path(self, key):
+        """
+        本地存储可以直接读取，不经过读穿透缓存。
+        """
+        path = _sharded_path(self.root, key)
+        return path if os.path.isfile(path) else None
+
+    def delete(self, key):
+        try:
+            os.remove(_sharded_path(self.root, key))
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore:
+    """
+    以 S3 兼容的对象存储作为共享存储。
+
+    参数：
+    - bucket: 存储桶名称
+    - endpoint_url: S3 兼容服务的地址，使用 AWS S3 时为 None
+    - prefix: 对象键的前缀
+    """
+
+    def __init__(self, bucket, endpoint_url=None, prefix=""):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("使用 S3 存储需要安装 boto3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _object_key(self, key):
+        return f"{self.prefix}{key}"
+
+    def put_stream(self, stream, suffix=""):
+        """
+        分块读取文件流并计算内容哈希，再上传到存储桶，返回存储键。对象已存在时不重复上传。
+        """
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as spool:
+            digest = _copy_hashing(stream, spool)
+            key = f"{digest}{suffix}"
+            try:
+                self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            except self.client.exceptions.ClientError:
+                spool.seek(0)
+                self.client.upload_fileobj(spool, self.bucket, self._object_key(key))
+        return key
+
+    def download(self, key, path):
+        self.client.download_file(self.bucket, self._object_key(key), path)
+
+    def local_path(self, key):
+        return None
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+
+def create_blob_store(name=BLOB_STORE, local_dir=BLOB_LOCAL_DIR, prefix=BLOB_S3_PREFIX):
+    """
+    按名称创建存储后端（local 或 s3）。
+    """
+    if name == "local":
+        return LocalBlobStore(local_dir)
+    if name == "s3":
+        return S3BlobStore(BLOB_S3_BUCKET, BLOB_S3_ENDPOINT, prefix)
+    raise ValueError(f"未知的存储后端: {name}")
+
+
+# 上传的成绩表
+blob_store = create_blob_store()
+# 生成的报告和批量打包文件
+report_store = create_blob_store(local_dir=GENERATED_REPORTS_DIR, prefix=f"{BLOB_S3_PREFIX}reports/")
+
+_cache_lock = threading.Lock()
+
+
+def put_file(path, suffix=None, store=None):
+    """
+    把本地文件写入共享存储（默认 blob_store），返回存储键。suffix 默认取文件的扩展名。
+    """
+    if suffix is None:
+        suffix = os.path.splitext(path)[1]
+    with open(path, "rb") as source:
+        return (store or blob_store).put_stream(source, suffix)
+
+
+def fetch(key, store=None):
+    """
+    返回可在本地读取的文件路径（默认从 blob_store 读取）。文件按内容命名、不会被修改，因此缓存中已有的
+    文件可以直接使用；否则先下载到读穿透缓存，并在缓存超出 BLOB_CACHE_MAX_BYTES 时删除最久未使用的文件。
+    """
+    store = store or blob_store
+    path = store.local_path(key)
+    if path is not None:
+        return path
+
+    path = _sharded_path(BLOB_CACHE_DIR, key)
+    if os.path.isfile(path):
+        os.utime(path)
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    store.download(key, temp_path)
+    os.replace(temp_path, path)
+    _trim_cache()
+    return path
+
+
+def _trim_cache():
+    with _cache_lock:
+        files = []
+        for directory, _, names in os.walk(BLOB_CACHE_DIR):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                file_path = os.path.join(directory, name)
+                stat = os.stat(file_path)
+                files.append((stat.st_mtime, stat.st_size, file_path))
+        total = sum(size for _, size, _ in files)
+        for _, size, file_path in sorted(files):
+            if total <= BLOB_CACHE_MAX_BYTES:
+                break
+            os.remove(file_path)
+            total -= size
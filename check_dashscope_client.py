@@ -0,0 +1,156 @@
+# check_dashscope_client.py
+"""
+用本地的模拟 DashScope 服务检查 DashScopeClient 的重试、流式输出和熔断行为。
+
+在本机随机端口启动一个 ThreadingHTTPServer，按预先排好的顺序返回状态码或流式事件，
+DASHSCOPE_BASE_URL 指向该服务，依次检查：500/429 后重试成功、400 不重试也不计入熔断、
+流式输出的中间结果、连续失败后熔断器打开以及冷却后由试探请求恢复。不访问外部网络。
+
+用法：
+    python check_dashscope_client.py
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # 每个请求取出 replies 中的下一项：整数为状态码，列表为流式输出的文本片段
+    replies = []
+    requests_seen = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        type(self).requests_seen += 1
+        reply = self.replies.pop(0) if self.replies else 200
+        if isinstance(reply, list):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream;charset=UTF-8")
+            self.end_headers()
+            for text in reply:
+                event = {"output": {"choices": [{"message": {"content": text}}]}}
+                self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            return
+        body = {"output": {"choices": [{"message": {"content": "ok"}}]}} if reply == 200 else {"code": str(reply)}
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(reply)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+# 必须在导入 ai_interface 之前设置
+os.environ["DASHSCOPE_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/api/v1"
+os.environ["AI_BACKEND"] = "dashscope"
+os.environ.setdefault("AI_CACHE_PATH", os.path.join(tempfile.gettempdir(), "check_dashscope_ai_cache.db"))
+
+from ai_interface import (
+    DASHSCOPE_BASE_URL, AIRequestError, CircuitBreaker, CircuitOpenError, DashScopeClient,
+)
+
+MESSAGES = [{"role": "user", "content": "test"}]
+
+
+def make_client(threshold=5, reset=60.0):
+    return DashScopeClient(
+        "test-key", DASHSCOPE_BASE_URL, max_retries=2, backoff_base=0.01, backoff_max=0.02,
+        breaker=CircuitBreaker(threshold, reset),
+    )
+
+
+def serve(*replies):
+    StubHandler.replies = list(replies)
+    StubHandler.requests_seen = 0
+
+
+def check_retry():
+    for status in (500, 429):
+        client = make_client()
+        serve(status, 200)
+        assert client.generate("m", MESSAGES, 5) == "ok"
+        assert StubHandler.requests_seen == 2, f"{status} 后应重试一次"
+        assert not client.breaker.is_open
+
+
+def check_client_error():
+    client = make_client(threshold=2)
+    for _ in range(3):
+        serve(400)
+        try:
+            client.generate("m", MESSAGES, 5)
+            raise AssertionError("400 应抛出 AIRequestError")
+        except AIRequestError as e:
+            assert e.status_code == 400
+        assert StubHandler.requests_seen == 1, "400 不应重试"
+    assert not client.breaker.is_open and client.breaker.failures == 0, "400 不应计入熔断"
+
+
+def check_streaming():
+    client = make_client()
+    partials = []
+    serve(["你好", "，", "世界"])
+    assert client.generate("m", MESSAGES, 5, on_partial=partials.append) == "你好，世界"
+    assert partials == ["你好", "你好，", "你好，世界"], partials
+
+
+def check_breaker():
+    # 每次调用最多请求 3 次（max_retries=2），3 次 500 后熔断器打开
+    client = make_client(threshold=3, reset=0.2)
+    serve(500, 500, 500)
+    try:
+        client.generate("m", MESSAGES, 5)
+        raise AssertionError("持续 500 应抛出 AIRequestError")
+    except AIRequestError as e:
+        assert e.status_code == 500
+    assert StubHandler.requests_seen == 3, "500 应重试到次数用完"
+    assert client.breaker.is_open, "连续失败后熔断器应打开"
+
+    serve(200)
+    try:
+        client.generate("m", MESSAGES, 5)
+        raise AssertionError("熔断期间应直接失败")
+    except CircuitOpenError:
+        pass
+    assert StubHandler.requests_seen == 0, "熔断期间不应发出请求"
+
+    time.sleep(0.25)
+    assert client.generate("m", MESSAGES, 5) == "ok"
+    assert not client.breaker.is_open, "试探请求成功后熔断器应关闭"
+
+    # 试探请求遇到 400 时同样关闭熔断器，不会停留在半开状态
+    serve(500, 500, 500)
+    try:
+        client.generate("m", MESSAGES, 5)
+    except AIRequestError:
+        pass
+    time.sleep(0.25)
+    serve(400, 200)
+    try:
+        client.generate("m", MESSAGES, 5)
+    except AIRequestError as e:
+        assert e.status_code == 400
+    assert not client.breaker.is_open, "试探请求遇到 400 后熔断器应关闭"
+    assert client.generate("m", MESSAGES, 5) == "ok"
+
+
+def main():
+    checks = [check_retry, check_client_error, check_streaming, check_breaker]
+    for check in checks:
+        check()
+        print(f"{check.__name__}: ok")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,155 +1,446 @@
 # data_processing.py
 
+import io
+import logging
 import os
+import tempfile
+import numpy as np
 import pandas as pd
-from flask import session
+from celery import shared_task
 from report_generation import generate_word_report
-from plotting import plot_distribution
+from plotting import render_distribution, render_grouped_distribution, PLOT_DPI
+import metrics
+from report_cache import report_cache
+from blob_store import fetch, key_digest
+from storage import save_artifact
+import jobs
+from jobs import job_registry
+from section_store import section_store, course_key, fingerprint
+from score_store import save_scores
+from formats import SCORE_FORMATS, detect_format, extract_fields
 
-def extract_text_between(text, start_str, end_str):
-    try:
-        start = text.index(start_str) + len(start_str)
-        end = text.index(end_str, start)
-        return text[start:end].strip()
-    except ValueError:
-        return ""
+SCORE_COLUMNS = ['平时', '实验', '期末', '总评']
+# 分班级统计时每个学生所属班级的列（由格式声明中的 class_marker 或 class_column 得到）
+CLASS_COLUMN = '班级'
 
-def extract_text_after(text, start_str):
-    try:
-        start = text.index(start_str) + len(start_str)
-        return text[start:].strip()
-    except ValueError:
-        return ""
+# 文字分布的分数段：[0,10), [10,20), ..., [80,90), [90,100]
+SCORE_BIN_EDGES = np.arange(0, 101, 10)
+TEXT_RANGES = [(i, i + 10) for i in range(0, 100, 10)]
+# 绘图分布的分数段由文字分布的分数段合并而来（0-60 合并前 6 段）
+PLOT_RANGES = [(0, 60), (60, 70), (70, 80), (80, 90), (90, 100)]
+PLOT_BIN_GROUPS = [slice(0, 6), slice(6, 7), slice(7, 8), slice(8, 9), slice(9, 10)]
+
+def _build_distribution(counts, ranges, total_count):
+    distribution = {}
+    for count, (lower, upper) in zip(counts, ranges):
+        percentage = (count / total_count * 100) if total_count > 0 else 0
+        distribution[f'{lower}-{upper}分'] = {'人数': count, '占比': round(percentage, 2)}
+    return distribution
 
-def extract_text_in_parentheses(text):
+def excel_engine():
+    """
+    选择读取 Excel 的引擎：已安装 python-calamine 且 pandas 支持时使用 calamine，否则使用 openpyxl。
+    """
     try:
-        start = text.index('(') + 1
-        end = text.index(')', start)
-        return text[start:end].strip()
-    except ValueError:
-        return ""
-
-def detect_format(df_preview):
-    for idx, row in df_preview.iterrows():
-        if "序号" in row.values:
-            return "format_1", idx
-        elif "编号" in row.values:
-            return "format_2", idx
-    return "unknown", None
+        import python_calamine  # noqa: F401
+        from pandas.io.excel import _calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return "openpyxl"
 
-def calculate_statistics(df, column):
-    total_count = df.shape[0]
-    stats = {
-        '总人数': total_count,
-        '最高分': df[column].max(),
-        '最低分': df[column].min(),
-        '平均分': "{:.2f}".format(df[column].mean()),
+def read_sheet_grid(file_path, sheet_name=0):
+    """
+    只解析一次工作表，返回不带表头的原始单元格网格（DataFrame）。
+    格式识别、表头单元格和成绩数据都从这份网格中切出，不再重复解析文件。
+    """
+    return pd.read_excel(file_path, sheet_name=sheet_name, header=None, engine=excel_engine())
+
+def list_sheet_names(file_path):
+    """
+    返回工作簿中全部工作表的名称（按顺序），不解析工作表内容。
+    """
+    with pd.ExcelFile(file_path, engine=excel_engine()) as workbook:
+        return list(workbook.sheet_names)
+
+def preview_from_grid(grid, nrows=6):
+    """
+    取出与 parse(nrows=6) 相同的预览行（第一行作为表头，不计入预览）。
+    """
+    return grid.iloc[1:nrows + 1].reset_index(drop=True)
+
+def frame_from_grid(grid, header_row, columns, usecols=None):
+    """
+    取出 header_row（网格中的行号）之后的数据行，并按 columns 命名各列。
+    给出 usecols（列名列表）时只取出这些列，其余列（姓名、备注等）不复制，也不做类型推断。
+    """
+    if usecols is None:
+        df = grid.iloc[header_row + 1:].reset_index(drop=True)
+        df.columns = columns
+        return df.infer_objects()
+    if grid.shape[1] != len(columns):
+        raise ValueError(f"Length mismatch: Expected axis has {grid.shape[1]} elements, new values have {len(columns)} elements")
+    positions = [columns.index(column) for column in usecols]
+    df = grid.iloc[header_row + 1:, positions].reset_index(drop=True)
+    df.columns = usecols
+    return df
+
+def class_labels(df, spec, sheet_class=None, default=""):
+    """
+    按格式声明 spec 返回每一行所属的班级。以 class_marker 开头的行（如"行政班：XXX"）之后的学生属于
+    班级 XXX（向下填充）；没有这样的行时，给出 sheet_class（每个工作表一个班级）则全部为 sheet_class，
+    否则取 class_column 列；都没有时全部为 default。
+    """
+    class_marker = spec.get("class_marker")
+    if class_marker:
+        id_values = df[spec["id_column"]]
+        # 班级行只会出现在序号不是数字的行中，只把这些行转换为文字
+        text = id_values[pd.to_numeric(id_values, errors='coerce').isna()].astype(str)
+        names = text[text.str.startswith(class_marker)].str.slice(len(class_marker)).str.strip()
+        if not names.empty:
+            labels = names.reindex(df.index).ffill()
+            return labels.fillna(default).astype("category")
+    if sheet_class is not None:
+        return pd.Series(str(sheet_class), index=df.index, dtype="category")
+    if spec.get("class_column"):
+        labels = df[spec["class_column"]].astype("string").str.strip()
+        return labels.fillna(default).astype("category")
+    return pd.Series(default, index=df.index, dtype="category")
+
+def clean_score_frame(df, id_column, score_columns):
+    """
+    只保留序号列为数字的学生行，并把成绩列转换为一个数值块，无法转换的（空白、"缺考"等）按 0 分处理。
+
+    数值块只分配一次，各成绩列依次转换后写入，同一时间只有一列的临时数据。数值块为 float64，
+    统计结果与逐列转换时完全相同；全部为整数且没有空白的列仍保持整数类型。
+    返回 (df_cleaned, coerced)：df_cleaned 由成绩列和 df 中除序号列外的其他列组成，
+    coerced 为 {成绩列: 按 0 分处理的成绩个数}，用于提示成绩表中的数据问题。
+    """
+    students = pd.to_numeric(df[id_column], errors='coerce').notna().to_numpy()
+    # 按列存放（Fortran 顺序），每列连续写入，构造 DataFrame 时也不需要再复制
+    values = np.empty((int(students.sum()), len(score_columns)), dtype=np.float64, order='F')
+    coerced = {}
+    integer_columns = {}
+    for i, column in enumerate(score_columns):
+        converted = pd.to_numeric(df[column].to_numpy()[students], errors='coerce')
+        if converted.dtype.kind in "iu":
+            integer_columns[column] = converted.dtype
+        missing = np.isnan(converted)
+        coerced[column] = int(missing.sum())
+        values[:, i] = converted
+        values[missing, i] = 0
+
+    df_cleaned = pd.DataFrame(values, columns=score_columns, copy=False)
+    # 最高分/最低分按列的数据类型显示，整数列转回整数，报告中的显示与之前一致
+    for column, dtype in integer_columns.items():
+        df_cleaned[column] = df_cleaned[column].astype(dtype)
+    for column in df.columns:
+        if column != id_column and column not in score_columns:
+            df_cleaned[column] = df[column].array[students]
+    return df_cleaned, coerced
+
+def describe_coerced(coerced):
+    """
+    把各成绩列按 0 分处理的个数写成提示文字，没有时返回 None。
+    """
+    parts = [f"{column} {count} 个" for column, count in coerced.items() if count]
+    if not parts:
+        return None
+    return f"成绩表中有空白或非数字的成绩，已按 0 分计算：{'，'.join(parts)}。"
+
+def describe_pending(sections):
+    """
+    把 AI 分析未能生成的部分写成提示文字，没有时返回 None。
+    """
+    if not sections:
+        return None
+    return f"以下 AI 分析部分暂未生成：{'，'.join(sections)}。稍后重新生成报告即可补充，其余部分会直接沿用。"
+
+def report_warning(result):
+    """
+    把报告生成结果中需要提示用户的问题（按 0 分处理的成绩、未生成的 AI 分析部分）写成一段文字，没有时返回 None。
+    """
+    parts = [describe_coerced(result["coerced_scores"]), describe_pending(result["pending_ai_sections"])]
+    return " ".join(part for part in parts if part) or None
+
+def _group_arrays(values, codes, n_groups):
+    """
+    按组编码 codes（0 到 n_groups - 1）一次汇总各组、各列的人数、分数段人数、最高分、最低分和总分。
+
+    所有列组成一个二维数组，用一次 searchsorted 完成分箱，再用一次 bincount 同时统计所有组、所有列
+    各分数段的人数；行按组排序后，最高分、最低分和总分各用一次 reduceat 按组求出。
+    """
+    n_bins = len(TEXT_RANGES)
+    n_columns = values.shape[1]
+
+    # 每个分数所在的分数段下标；100 分归入最后一段，超出 [0, 100] 的分数不计入任何分数段
+    bin_index = np.searchsorted(SCORE_BIN_EDGES, values, side='right') - 1
+    bin_index[values == SCORE_BIN_EDGES[-1]] = n_bins - 1
+    valid = (bin_index >= 0) & (bin_index < n_bins)
+    cell_offset = (codes[:, None] * n_columns + np.arange(n_columns)) * n_bins
+    flat_index = (bin_index + cell_offset)[valid]
+    bin_counts = np.bincount(flat_index, minlength=n_groups * n_columns * n_bins)
+    bin_counts = bin_counts.reshape(n_groups, n_columns, n_bins)
+
+    sizes = np.bincount(codes, minlength=n_groups)
+    maxima = np.full((n_groups, n_columns), np.nan)
+    minima = np.full((n_groups, n_columns), np.nan)
+    sums = np.zeros((n_groups, n_columns))
+    present = sizes > 0
+    if present.any():
+        sorted_values = values[np.argsort(codes, kind='stable')]
+        starts = (np.cumsum(sizes) - sizes)[present]
+        maxima[present] = np.maximum.reduceat(sorted_values, starts, axis=0)
+        minima[present] = np.minimum.reduceat(sorted_values, starts, axis=0)
+        sums[present] = np.add.reduceat(sorted_values, starts, axis=0)
+    return sizes, bin_counts, maxima, minima, sums
+
+def _column_results(columns, column_types, total_count, bin_counts, maxima, minima, sums):
+    # 由一组的汇总数组生成 {列名: (stats, distribution_text, distribution_plot)}；
+    # 5 段绘图分布由 10 段文字分布的人数合并得到，不再重新扫描
+    results = {}
+    for i, column in enumerate(columns):
+        mean = sums[i] / total_count if total_count > 0 else np.nan
+        stats = {
+            '总人数': total_count,
+            '最高分': column_types[i](maxima[i]),
+            '最低分': column_types[i](minima[i]),
+            '平均分': "{:.2f}".format(mean),
+        }
+        text_counts = bin_counts[i]
+        plot_counts = [text_counts[group].sum() for group in PLOT_BIN_GROUPS]
+        distribution_text = _build_distribution(text_counts, TEXT_RANGES, total_count)
+        distribution_plot = _build_distribution(plot_counts, PLOT_RANGES, total_count)
+        results[column] = (stats, distribution_text, distribution_plot)
+    return results
+
+def _column_types(df, columns):
+    # 最高分/最低分保持原列的数据类型，保证报告中的显示与之前一致
+    return [df[column].dtype.type if df.shape[0] > 0 else float for column in columns]
+
+def calculate_all_statistics(df, columns):
+    """
+    一次性计算多列成绩的统计数据和分数段分布。
+
+    返回以列名为键的字典，值为 (stats, distribution_text, distribution_plot)，
+    与 calculate_statistics 的返回值相同。
+    """
+    values = df[columns].to_numpy(dtype=np.float64)
+    codes = np.zeros(len(values), dtype=np.intp)
+    sizes, bin_counts, maxima, minima, sums = _group_arrays(values, codes, 1)
+    return _column_results(
+        columns, _column_types(df, columns), int(sizes[0]), bin_counts[0], maxima[0], minima[0], sums[0]
+    )
+
+def calculate_grouped_statistics(df, columns, group_column):
+    """
+    按 group_column（例如班级）分组，一次扫描同时得到合并统计和各组的统计。
+
+    合并统计由各组的汇总相加得到（人数和分数段人数相加、最高分/最低分取极值、总分相加），
+    不再单独扫描一遍。返回 (combined, by_group)：combined 与 calculate_all_statistics 的返回值相同，
+    by_group 为 {组名: 同样结构的字典}，组按首次出现的顺序排列。
+    """
+    values = df[columns].to_numpy(dtype=np.float64)
+    codes, groups = pd.factorize(df[group_column], sort=False)
+    sizes, bin_counts, maxima, minima, sums = _group_arrays(values, codes.astype(np.intp), len(groups))
+    column_types = _column_types(df, columns)
+
+    by_group = {
+        group: _column_results(columns, column_types, int(sizes[i]), bin_counts[i], maxima[i], minima[i], sums[i])
+        for i, group in enumerate(groups)
     }
-    score_ranges = [(i, i+10) for i in range(0, 90, 10)]
-    score_ranges.append((90, 100))
-    distribution_text = {}
+    if len(groups) > 0:
+        combined_extrema = (maxima.max(axis=0), minima.min(axis=0))
+    else:
+        combined_extrema = (np.full(len(columns), np.nan), np.full(len(columns), np.nan))
+    combined = _column_results(
+        columns, column_types, int(sizes.sum()), bin_counts.sum(axis=0), *combined_extrema, sums.sum(axis=0)
+    )
+    return combined, by_group
 
-    for lower, upper in score_ranges:
-        if upper == 100:
-            count = df[column].between(lower, upper, inclusive='both').sum()
-        else:
-            count = df[column].between(lower, upper, inclusive='left').sum()
+def calculate_statistics(df, column):
+    return calculate_all_statistics(df, [column])[column]
 
-        percentage = (count / total_count * 100) if total_count > 0 else 0
-        distribution_text[f'{lower}-{upper}分'] = {'人数': count, '占比': round(percentage, 2)}
+# 设置 SAVE_PLOTS=1 时，除嵌入报告外还把分布图保存到上传目录（调试/导出用）
+SAVE_PLOTS = os.getenv("SAVE_PLOTS", "").lower() in ("1", "true", "yes")
 
-    plot_ranges = [(0, 60), (60, 70), (70, 80), (80, 90), (90, 100)]
-    distribution_plot = {}
-    for lower, upper in plot_ranges:
-        if upper == 100:
-            count = df[column].between(lower, upper, inclusive='both').sum()
-        else:
-            count = df[column].between(lower, upper, inclusive='left').sum()
-        percentage = (count / total_count * 100) if total_count > 0 else 0
-        distribution_plot[f'{lower}-{upper}分'] = {'人数': count, '占比': round(percentage, 2)}
-    
-    return stats, distribution_text, distribution_plot
+def update_progress(session_id, progress, status, progress_callback=None, **extra):
+    """
+    报告生成进度：有回调时交给回调处理（例如 Celery 任务），否则直接写入任务登记表。
+    extra 为附加信息，例如 AI 分析的文本预览 preview。
+    """
+    if progress_callback is not None:
+        progress_callback(progress, status, **extra)
+    elif session_id:
+        job_registry.update(session_id, status=jobs.IN_PROGRESS, progress=progress, message=status, preview=extra.get('preview'))
+
+def parse_score_sheet(sheet, job_id=None, sheet_class=None, default_class=""):
+    """
+    识别一个工作表的格式，取出学期和课程名称并清洗成绩数据。
+
+    返回 (semester_info, course_name, df_cleaned, coerced)，无法识别格式时返回 None。
+    df_cleaned 只含成绩列和 CLASS_COLUMN 列（每个学生所属的班级，见 class_labels），
+    coerced 见 clean_score_frame。
+    """
+    # Detect file format
+    with metrics.span("detect", job_id):
+        df_preview = preview_from_grid(sheet)
+        file_format, start_row = detect_format(df_preview)
+    spec = SCORE_FORMATS.get(file_format)
+    if spec is None:
+        return None
+    fields = extract_fields(sheet, spec)
+
+    with metrics.span("clean", job_id):
+        # 预览的第 start_row 行对应网格的第 start_row + 1 行（表头行）
+        # 只取出序号列、成绩列和班级列
+        usecols = [spec["id_column"], *SCORE_COLUMNS]
+        if spec.get("class_column"):
+            usecols.append(spec["class_column"])
+        df = frame_from_grid(sheet, start_row + 1, spec["columns"], usecols)
+        labels = class_labels(df, spec, sheet_class, default_class)
+        df = df[[spec["id_column"], *SCORE_COLUMNS]].assign(**{CLASS_COLUMN: labels})
+        df_cleaned, coerced = clean_score_frame(df, spec["id_column"], SCORE_COLUMNS)
+    semester_info, course_name = fields.get("semester_info", ""), fields.get("course_name", "")
+    return semester_info, course_name, df_cleaned, coerced
 
-def run_report_generation(file_path, class_name1, class_name2, session_id, report_style="formal"):
+def run_report_generation(file_path, class_name1, class_name2, session_id, report_style="formal", use_cache=True, progress_callback=None, save_plots=None, base_name=None, output_path=None, dataset_id=None, group_by_class=False, sheet_name=None):
+    """
+    生成一份成绩报告。base_name（报告文件名的前缀）默认取成绩表的文件名，
+    output_path（报告和图片的输出目录）默认为成绩表所在目录下与其同名的子目录。
+    给出 dataset_id（工作簿的 ID）时，清洗后的成绩和统计数据保存到列式成绩库（score_store）中，
+    每个工作表一个数据集，ID 由 dataset_id 和工作表名称生成，合并报告和按工作表生成的报告写入相同的数据集。
+    工作簿中的全部工作表合并为一份报告（无法识别格式的工作表被跳过）；给出 sheet_name 时只处理该工作表。
+    group_by_class 为 True 时除合并统计外还按班级分别统计，报告中附上各班级的对比表和对比图。
+    """
     if not os.path.exists(file_path):
         return {"status": "error", "message": "文件不存在，请检查文件名和路径。"}
+    if save_plots is None:
+        save_plots = SAVE_PLOTS
 
-    excel_dir = os.path.dirname(file_path)
-    output_dir = os.path.splitext(os.path.basename(file_path))[0].strip()
-    output_path = os.path.join(excel_dir, output_dir)
+    if base_name is None:
+        base_name = os.path.splitext(os.path.basename(file_path))[0].strip()
+    if output_path is None:
+        output_path = os.path.join(os.path.dirname(file_path), base_name)
 
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    # Initialize session progress tracking
-    session[session_id] = {"progress": 0, "status": "正在读取Excel文件..."}
+    # Initialize progress tracking
+    update_progress(session_id, 0, "正在读取Excel文件...", progress_callback)
     
-    xl = pd.ExcelFile(file_path)
-    base_name = os.path.splitext(os.path.basename(file_path))[0].strip()
-
-    df_preview = xl.parse(xl.sheet_names[0], nrows=6)
+    job_id = session_id or base_name
 
-    # Detect file format
-    file_format, start_row = detect_format(df_preview)
-
-    # Initialize variables for semester info and course name
-    semester_info = ""
-    course_name = ""
-
-    if file_format == "format_1":
-        sheet = xl.parse(xl.sheet_names[0], header=None)
-        cell_A1 = sheet.iloc[0, 0]
-        semester_info = extract_text_between(cell_A1, "厦门理工学院", "成绩登记表")
-        cell_A3 = sheet.iloc[2, 0]
-        course_name = extract_text_after(cell_A3, "课程名称：")
-        df = xl.parse(xl.sheet_names[0], skiprows=start_row + 1)
-        df.columns = ['序号', '姓名', '学号', 'Unnamed: 3', '平时', '实验', '期末', '总评', '备注']
-        id_column = '序号'
-    elif file_format == "format_2":
-        sheet = xl.parse(xl.sheet_names[0], header=None)
-        cell_A2 = sheet.iloc[1, 0]
-        semester_info = extract_text_in_parentheses(cell_A2)
-        cell_E3 = sheet.iloc[2, 4]
-        course_name = cell_E3.strip()
-        df = xl.parse(xl.sheet_names[0], skiprows=start_row + 1)
-        df.columns = ['编号', '学号', '姓名', 'Unnamed: 3', 'Unnamed: 4', '平时', '实验', '期末', '总评', '备注']
-        id_column = '编号'
-    else:
+    # 逐个解析工作表：每个工作表只读取一次，识别格式并清洗后只保留清洗后的成绩，
+    # 同一时间只有一个工作表的原始网格在内存中
+    parsed = []
+    parsed_names = []
+    with pd.ExcelFile(file_path, engine=excel_engine()) as workbook:
+        sheet_names = [sheet_name] if sheet_name is not None else workbook.sheet_names
+        for i, name in enumerate(sheet_names):
+            if len(sheet_names) > 1:
+                update_progress(session_id, 5 * i // len(sheet_names), f"正在读取工作表：{name} ({i + 1}/{len(sheet_names)})", progress_callback)
+            with metrics.span("ingest", job_id, sheet=name):
+                sheet = workbook.parse(name, header=None)
+            # 有多个工作表且没有"行政班"行时，以工作表名称作为班级
+            sheet_class = name if len(sheet_names) > 1 else None
+            result = parse_score_sheet(sheet, job_id, sheet_class, class_name1 or "")
+            del sheet
+            if result is None:
+                logging.info("跳过无法识别格式的工作表: %s", name)
+                continue
+            parsed.append(result)
+            parsed_names.append(name)
+    if not parsed:
         return {"status": "error", "message": "无法识别的文件格式。"}
 
-    # Clean data
-    df_cleaned = df[pd.to_numeric(df[id_column], errors='coerce').notnull()].copy()
-    score_columns = ['平时', '实验', '期末', '总评']
-    for column in score_columns:
-        df_cleaned[column] = pd.to_numeric(df_cleaned[column], errors='coerce').fillna(0)
+    # 学期和课程名称取自第一个能识别的工作表
+    semester_info, course_name, _, _ = parsed[0]
+    df_cleaned = pd.concat([df for _, _, df, _ in parsed], ignore_index=True) if len(parsed) > 1 else parsed[0][2]
+    coerced = {column: sum(result[3][column] for result in parsed) for column in SCORE_COLUMNS}
+    if describe_coerced(coerced):
+        logging.warning("%s: %s", base_name, describe_coerced(coerced))
+    score_columns = SCORE_COLUMNS
 
     total_students = df_cleaned.shape[0]
 
-    # Update session progress
-    session[session_id]["progress"] = 20
-    session[session_id]["status"] = "正在计算统计数据..."
+    # Update progress
+    update_progress(session_id, 10, "正在计算统计数据...", progress_callback)
+
+    # 分班级统计时合并统计和各班级的统计在同一次扫描中得到；只有一个班级时与合并统计相同，不再单独列出
+    class_statistics = {}
+    with metrics.span("stats", job_id):
+        if group_by_class:
+            all_statistics, class_statistics = calculate_grouped_statistics(df_cleaned, score_columns, CLASS_COLUMN)
+        else:
+            all_statistics = calculate_all_statistics(df_cleaned, score_columns)
+    if len(class_statistics) < 2:
+        class_statistics = {}
+
+    if dataset_id is not None:
+        # 保存失败（例如未安装 pyarrow）不影响报告生成
+        try:
+            with metrics.span("persist", job_id):
+                class_name = "、".join(name for name in (class_name1, class_name2) if name)
+                for name, (sheet_semester, sheet_course, df_sheet, _) in zip(parsed_names, parsed):
+                    sheet_statistics = all_statistics if len(parsed) == 1 else calculate_all_statistics(df_sheet, score_columns)
+                    save_scores(
+                        fingerprint(dataset_id, name), sheet_course, sheet_semester, class_name, df_sheet, sheet_statistics
+                    )
+        except Exception:
+            logging.exception("无法保存成绩数据: %s", dataset_id)
+
+    # 与同一课程上一次生成的各部分比较指纹，没有变化的图和 AI 分析直接复用；
+    # 强制重新生成（use_cache=False）时全部重新计算
+    build_key = course_key(semester_info, course_name, class_name1, class_name2, sheet_name)
+    previous_sections = section_store.load(build_key) if use_cache else {}
+    reused_plots = []
 
     all_scores_data = []
     for i, score_type in enumerate(score_columns):
-        stats, distribution_text, distribution_plot = calculate_statistics(df_cleaned, score_type)
+        stats, distribution_text, distribution_plot = all_statistics[score_type]
         plot_title = f"{score_type}成绩分布"
-        plot_file_name = os.path.join(output_path, f"{base_name}_{plot_title}.png")
-        plot_distribution(distribution_plot, plot_title, plot_file_name)
-        all_scores_data.append({
+        plot_section = f"plot:{score_type}"
+        plot_fingerprint = fingerprint(plot_title, distribution_plot, PLOT_DPI)
+        previous = previous_sections.get(plot_section)
+        if previous is not None and previous[0] == plot_fingerprint:
+            plot_image = io.BytesIO(previous[1])
+            reused_plots.append(plot_title)
+        else:
+            update_progress(session_id, 10 + i * 10, f"正在绘制{plot_title}图...", progress_callback)
+            with metrics.span("plot", job_id, score_type=score_type):
+                plot_image = render_distribution(distribution_plot, plot_title)
+            section_store.save(build_key, plot_section, plot_fingerprint, plot_image.getvalue())
+        score_data = {
             'score_type': score_type,
             'stats': stats,
             'distribution_text': distribution_text,
             'distribution_plot': distribution_plot,
-            'plot_file_name': plot_file_name
-        })
-        # Update session progress
-        progress_increment = int(60 / len(score_columns))
-        session[session_id]["progress"] += progress_increment
-        session[session_id]["status"] = f"正在处理 {score_type} 成绩数据..."
+            'plot_image': plot_image
+        }
+        if class_statistics:
+            class_title = f"{score_type}各班级成绩分布"
+            class_section = f"class_plot:{score_type}"
+            class_plots = {name: statistics[score_type][2] for name, statistics in class_statistics.items()}
+            class_fingerprint = fingerprint(class_title, class_plots, PLOT_DPI)
+            previous = previous_sections.get(class_section)
+            if previous is not None and previous[0] == class_fingerprint:
+                score_data['class_plot_image'] = io.BytesIO(previous[1])
+                reused_plots.append(class_title)
+            else:
+                with metrics.span("plot", job_id, score_type=score_type, grouped=True):
+                    score_data['class_plot_image'] = render_grouped_distribution(class_plots, class_title)
+                section_store.save(build_key, class_section, class_fingerprint, score_data['class_plot_image'].getvalue())
+            score_data['class_statistics'] = {name: statistics[score_type] for name, statistics in class_statistics.items()}
+        if save_plots:
+            plot_file_name = os.path.join(output_path, f"{base_name}_{plot_title}.png")
+            with open(plot_file_name, 'wb') as plot_file:
+                plot_file.write(score_data['plot_image'].getvalue())
+            score_data['plot_file_name'] = plot_file_name
+        all_scores_data.append(score_data)
 
     # Generate Word report
     report_path = os.path.join(output_path, f"{base_name}_成绩信息汇总.docx")
-    generate_word_report(
+    word_report = generate_word_report(
         base_name,
         report_path,
         all_scores_data,
@@ -159,15 +450,98 @@ def run_report_generation(file_path, class_name1, class_name2, session_id, repor
         total_students,
         class_name1,
         class_name2,
-        report_style=report_style
+        report_style=report_style,
+        use_cache=use_cache,
+        progress_callback=lambda progress, status, **extra: update_progress(session_id, progress, status, progress_callback, **extra),
+        job_id=job_id,
+        build_key=build_key,
+        previous_sections=previous_sections
     )
 
-    session[session_id]["progress"] = 100
-    session[session_id]["status"] = "完成"
+    update_progress(session_id, 100, "完成", progress_callback)
 
     return {
         "status": "success",
         "report_path": report_path,
         "output_path": output_path,
-        "session_id": session_id
+        "session_id": session_id,
+        "pending_ai_sections": word_report["pending_ai_sections"],
+        "reused_sections": reused_plots + word_report["reused_sections"],
+        "coerced_scores": coerced
     }
+
+def generate_report_from_blob(blob_key, original_name, class_name1, class_name2, session_id, report_style="formal", use_cache=True, progress_callback=None, cache_key=None, group_by_class=False, sheet_name=None):
+    """
+    从共享存储读取成绩表并生成报告，报告存回共享存储。web 进程和 worker 进程不共享磁盘，
+    返回值中用 report_key（存储键）和 report_name（下载文件名）代替本地路径。
+    图片等中间文件只写在临时目录中，报告存储后立即删除。
+    给出 cache_key 时，完整生成（没有待补充 AI 分析部分）的报告会登记到报告缓存中。
+    给出 sheet_name 时只为该工作表生成报告，报告文件名中附上工作表名称。
+    """
+    file_path = fetch(blob_key)
+    base_name = os.path.splitext(os.path.basename(original_name.replace("\\", "/")))[0].strip()
+    if sheet_name is not None:
+        base_name = f"{base_name}_{sheet_name}"
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = run_report_generation(
+            file_path,
+            class_name1,
+            class_name2,
+            session_id,
+            report_style=report_style,
+            use_cache=use_cache,
+            progress_callback=progress_callback,
+            base_name=base_name,
+            output_path=work_dir,
+            dataset_id=key_digest(blob_key),
+            group_by_class=group_by_class,
+            sheet_name=sheet_name
+        )
+        if result["status"] != "success":
+            return result
+        report_path = result.pop("report_path")
+        result.pop("output_path")
+        result["report_key"] = save_artifact(report_path)
+        result["report_name"] = os.path.basename(report_path)
+        if cache_key and not result["pending_ai_sections"]:
+            report_cache.put(
+                cache_key, result["report_key"], result["report_name"], os.path.getsize(report_path),
+                warning=report_warning(result)
+            )
+    return result
+
+@shared_task
+def generate_report_task(blob_key, original_name, class_name1, class_name2, job_id, report_style="formal", use_cache=True, cache_key=None, group_by_class=False):
+    """
+    在 Celery worker 中运行完整的报告生成流程，每个阶段的进度和最终结果都写入任务登记表。
+    """
+    def progress_callback(progress, status, **extra):
+        job_registry.update(job_id, status=jobs.IN_PROGRESS, progress=progress, message=status, preview=extra.get('preview'))
+
+    try:
+        with metrics.profiled(job_id), metrics.span("job", job_id):
+            result = generate_report_from_blob(
+                blob_key,
+                original_name,
+                class_name1,
+                class_name2,
+                job_id,
+                report_style=report_style,
+                use_cache=use_cache,
+                progress_callback=progress_callback,
+                cache_key=cache_key,
+                group_by_class=group_by_class
+            )
+    except Exception as e:
+        job_registry.update(job_id, status=jobs.FAILED, progress=0, message=str(e), preview=None)
+        raise
+
+    if result["status"] == "success":
+        job_registry.update(
+            job_id, status=jobs.COMPLETED, progress=100, message="完成", preview=None,
+            report_key=result["report_key"], report_name=result["report_name"],
+            warning=report_warning(result)
+        )
+    else:
+        job_registry.update(job_id, status=jobs.FAILED, progress=0, message=result.get("message", ""), preview=None)
+    return result
@@ -0,0 +1,157 @@
+# formats.py
+"""
+成绩登记表格式的声明式登记表。
+
+每种格式声明以下内容，识别和解析的代码对所有格式都相同，新增教务系统的导出格式只需增加一项声明
+（写在 SCORE_FORMATS 中，或放在 SCORE_FORMATS_PATH 指向的 JSON 文件中）：
+
+- markers: 表头行中能识别该格式的单元格文字，如 "序号"；
+- columns: 表头行之后各列的名称，需包含 SCORE_COLUMNS 中的成绩列；
+- id_column: 序号列，只有该列为数字的行是学生行；
+- class_marker: 标出班级的行在序号列中的前缀（如 "行政班："），没有时为 None；
+- class_column: 按列给出班级（或专业）的列名，没有时为 None；
+- fields: 表头单元格中的信息（学期 semester_info、课程名称 course_name），
+  每项给出单元格位置 cell（行号, 列号）和提取规则 rule（EXTRACTORS 中的名称及其参数）。
+
+识别格式时，预览中的所有单元格与全部格式的表头标记一次比较（见 detect_format），
+耗时不随格式数量增加。
+"""
+
+import json
+import logging
+import os
+import numpy as np
+
+SCORE_FORMATS_PATH = os.getenv("SCORE_FORMATS_PATH")
+
+
+def extract_text_between(text, start_str, end_str):
+    try:
+        start = text.index(start_str) + len(start_str)
+        end = text.index(end_str, start)
+        return text[start:end].strip()
+    except ValueError:
+        return ""
+
+
+def extract_text_after(text, start_str):
+    try:
+        start = text.index(start_str) + len(start_str)
+        return text[start:].strip()
+    except ValueError:
+        return ""
+
+
+def extract_text_in_parentheses(text):
+    try:
+        start = text.index('(') + 1
+        end = text.index(')', start)
+        return text[start:end].strip()
+    except ValueError:
+        return ""
+
+
+# 表头单元格的提取规则：rule 的第一项为名称，其余为参数
+EXTRACTORS = {
+    "between": extract_text_between,
+    "after": extract_text_after,
+    "parentheses": extract_text_in_parentheses,
+    "strip": lambda text: text.strip(),
+}
+
+# 两种已知成绩登记表的格式，按识别的优先顺序排列
+SCORE_FORMATS = {
+    # 厦门理工学院XXXX学年第X学期成绩登记表，学生按"行政班：XXX"行分班列出
+    "format_1": {
+        "markers": ["序号"],
+        "columns": ['序号', '姓名', '学号', 'Unnamed: 3', '平时', '实验', '期末', '总评', '备注'],
+        "id_column": '序号',
+        "class_marker": '行政班：',
+        "class_column": None,
+        "fields": {
+            "semester_info": {"cell": [0, 0], "rule": ["between", "厦门理工学院", "成绩登记表"]},
+            "course_name": {"cell": [2, 0], "rule": ["after", "课程名称："]},
+        },
+    },
+    # 厦门理工学院学生成绩登记表 (XXXX学年第X学期)，每个学生有专业名称列
+    "format_2": {
+        "markers": ["编号"],
+        "columns": ['编号', '学号', '姓名', 'Unnamed: 3', 'Unnamed: 4', '平时', '实验', '期末', '总评', '备注'],
+        "id_column": '编号',
+        "class_marker": None,
+        "class_column": 'Unnamed: 4',
+        "fields": {
+            "semester_info": {"cell": [1, 0], "rule": ["parentheses"]},
+            "course_name": {"cell": [2, 4], "rule": ["strip"]},
+        },
+    },
+}
+
+logger = logging.getLogger(__name__)
+
+# 表头标记 -> 格式名称，以及各格式的优先顺序；由 register_format 维护
+_marker_index = {}
+_priority = {}
+
+
+def register_format(name, spec):
+    """
+    登记（或替换）一种格式并更新表头标记索引。先登记的格式在同一行中同时匹配时优先。
+    """
+    for rule in [field["rule"] for field in spec["fields"].values()]:
+        if rule[0] not in EXTRACTORS:
+            raise ValueError(f"格式 {name} 使用了未知的提取规则: {rule[0]}")
+    SCORE_FORMATS[name] = spec
+    _priority.setdefault(name, len(_priority))
+    for marker in spec["markers"]:
+        # 同一个标记属于多种格式时，由先登记的格式识别
+        if marker not in _marker_index or _priority[_marker_index[marker]] > _priority[name]:
+            _marker_index[marker] = name
+
+
+def load_formats(path):
+    """
+    从 JSON 文件读取附加的格式声明（{名称: 声明}，结构与 SCORE_FORMATS 相同）并登记。
+    """
+    with open(path, encoding="utf-8") as formats_file:
+        for name, spec in json.load(formats_file).items():
+            register_format(name, spec)
+
+
+for _name, _spec in list(SCORE_FORMATS.items()):
+    register_format(_name, _spec)
+
+if SCORE_FORMATS_PATH:
+    try:
+        load_formats(SCORE_FORMATS_PATH)
+    except Exception:
+        logger.exception("无法读取成绩登记表格式文件: %s", SCORE_FORMATS_PATH)
+
+
+def detect_format(df_preview):
+    """
+    在预览中查找第一个含有表头标记的行，返回 (格式名称, 行号)；找不到时返回 ("unknown", None)。
+
+    所有单元格与全部标记用一次 isin 比较；同一行匹配多种格式时取优先的格式。
+    """
+    hits = df_preview.isin(_marker_index.keys()).to_numpy()
+    rows = np.flatnonzero(hits.any(axis=1))
+    if rows.size == 0:
+        return "unknown", None
+    row = rows[0]
+    matched = {_marker_index[value] for value in df_preview.iloc[row].to_numpy()[hits[row]]}
+    return min(matched, key=_priority.get), df_preview.index[row]
+
+
+def extract_fields(sheet, spec):
+    """
+    按格式声明从工作表（原始单元格网格）的表头单元格中提取学期、课程名称等信息，返回字典。
+    单元格不存在或不是文字时对应的值为空字符串。
+    """
+    fields = {}
+    for field, rule in spec["fields"].items():
+        row, column = rule["cell"]
+        value = sheet.iat[row, column] if row < sheet.shape[0] and column < sheet.shape[1] else None
+        name, *args = rule["rule"]
+        fields[field] = EXTRACTORS[name](value, *args) if isinstance(value, str) else ""
+    return fields
@@ -0,0 +1,113 @@
+# jobs.py
+"""
+服务端的报告任务登记表。
+
+每个任务（单个报告或一个批次）的状态、进度、Celery 任务 ID 和生成结果的存储键保存在
+Redis 哈希中（键 report_job:<job_id>，JOB_TTL 秒后过期），任何 web 进程都能以一次
+HGETALL 读取，worker 也能直接更新。每次更新同时向 report_job_events:<job_id> 频道发布
+通知，SSE 进度推送订阅该频道。未配置 REDISCLOUD_URL 时保存在当前进程内存中（仅用于本地开发）。
+"""
+
+import json
+import logging
+import os
+import threading
+
+JOB_TTL = int(os.getenv("JOB_TTL", str(7 * 24 * 3600)))
+REDIS_KEY_PREFIX = "report_job:"
+CHANNEL_PREFIX = "report_job_events:"
+
+# 任务状态，也是返回给前端的 status
+PENDING = "pending"
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+
+class JobRegistry:
+    """
+    任务登记表。字段值以 JSON 编码保存，读取时还原为原来的类型。
+
+    参数：
+    - url: Redis 地址，为空时使用进程内存
+    - ttl: 任务记录的有效期（秒）
+    """
+
+    def __init__(self, url, ttl):
+        self.url = url
+        self.ttl = ttl
+        self._redis = None
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def _client(self):
+        if not self.url:
+            return None
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(self.url)
+        return self._redis
+
+    def create(self, job_id, **fields):
+        """
+        登记一个新任务，默认状态为 pending。
+        """
+        self.update(job_id, **{"status": PENDING, "progress": 0, **fields})
+
+    def update(self, job_id, **fields):
+        """
+        更新任务的部分字段并通知订阅者。
+        """
+        client = self._client()
+        if client is None:
+            with self._lock:
+                self._local.setdefault(job_id, {}).update(fields)
+            return
+        key = REDIS_KEY_PREFIX + job_id
+        pipeline = client.pipeline()
+        pipeline.hset(key, mapping={name: json.dumps(value, ensure_ascii=False) for name, value in fields.items()})
+        pipeline.expire(key, self.ttl)
+        pipeline.publish(CHANNEL_PREFIX + job_id, "updated")
+        pipeline.execute()
+
+    def increment(self, job_id, field, amount=1):
+        """
+        原子地增加一个计数字段，返回增加后的值。
+        """
+        client = self._client()
+        if client is None:
+            with self._lock:
+                job = self._local.setdefault(job_id, {})
+                job[field] = job.get(field, 0) + amount
+                return job[field]
+        return client.hincrby(REDIS_KEY_PREFIX + job_id, field, amount)
+
+    def get(self, job_id):
+        """
+        返回任务的全部字段，任务不存在或已过期时返回 None。
+        """
+        client = self._client()
+        if client is None:
+            with self._lock:
+                job = self._local.get(job_id)
+                return dict(job) if job is not None else None
+        values = client.hgetall(REDIS_KEY_PREFIX + job_id)
+        if not values:
+            return None
+        return {name.decode(): json.loads(value) for name, value in values.items()}
+
+    def subscribe(self, job_id):
+        """
+        订阅任务的更新通知，返回 Redis PubSub 对象；使用进程内存时返回 None（调用方改为轮询）。
+        """
+        client = self._client()
+        if client is None:
+            return None
+        pubsub = client.pubsub()
+        pubsub.subscribe(CHANNEL_PREFIX + job_id)
+        return pubsub
+
+
+job_registry = JobRegistry(os.getenv("REDISCLOUD_URL"), JOB_TTL)
@@ -0,0 +1,158 @@
+# metrics.py
+"""
+报告生成任务的分阶段计时、Prometheus 指标和可选的 cProfile 性能分析。
+
+每个阶段（读取、格式识别、清洗、统计、每张图、每次 AI 调用、文档构建、保存）用 span() 计时，
+结果以 JSON 写入日志，并累加到按阶段划分的直方图中。配置了 REDISCLOUD_URL 时直方图保存在
+Redis 中，web 进程和 worker 进程共享同一份数据；否则保存在当前进程内存中。
+"""
+
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+
+# 直方图的分桶上限（秒）
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_NAME = "report_stage_duration_seconds"
+REDIS_KEY_PREFIX = "report_metrics:stage:"
+
+# 设置 REPORT_PROFILE=1 时，每个任务都保存一份 cProfile 结果到 PROFILE_DIR
+REPORT_PROFILE = os.getenv("REPORT_PROFILE", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join("instance", "profiles"))
+
+logger = logging.getLogger("report.timing")
+
+_redis_client = None
+_local_histograms = {}
+_local_lock = threading.Lock()
+
+
+def _get_redis():
+    global _redis_client
+    url = os.getenv("REDISCLOUD_URL")
+    if not url:
+        return None
+    if _redis_client is None:
+        import redis
+        _redis_client = redis.Redis.from_url(url)
+    return _redis_client
+
+
+def _bucket_fields(seconds):
+    fields = [str(bound) for bound in STAGE_BUCKETS if seconds <= bound]
+    fields.append("+Inf")
+    return fields
+
+
+def observe(stage, seconds):
+    """
+    将一次阶段耗时记入该阶段的直方图。
+    """
+    client = _get_redis()
+    if client is not None:
+        try:
+            key = REDIS_KEY_PREFIX + stage
+            pipeline = client.pipeline()
+            for field in _bucket_fields(seconds):
+                pipeline.hincrby(key, field, 1)
+            pipeline.hincrby(key, "count", 1)
+            pipeline.hincrbyfloat(key, "sum", seconds)
+            pipeline.execute()
+            return
+        except Exception as e:
+            logger.warning(f"无法写入 Redis 指标: {e}")
+
+    with _local_lock:
+        histogram = _local_histograms.setdefault(stage, {})
+        for field in _bucket_fields(seconds):
+            histogram[field] = histogram.get(field, 0) + 1
+        histogram["count"] = histogram.get("count", 0) + 1
+        histogram["sum"] = histogram.get("sum", 0.0) + seconds
+
+
+def record(stage, seconds, job_id=None, status="ok", **labels):
+    """
+    记录一个已完成阶段的耗时：以 JSON 写入日志并记入直方图。labels 为附加信息（如成绩类型、AI 分析部分），只写入日志。
+    """
+    logger.info(json.dumps(
+        {"event": "stage", "job": job_id, "stage": stage, "seconds": round(seconds, 6), "status": status, **labels},
+        ensure_ascii=False
+    ))
+    observe(stage, seconds)
+
+
+@contextlib.contextmanager
+def span(stage, job_id=None, **labels):
+    """
+    计时一个代码块，结束时调用 record()。
+    """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, job_id, status, **labels)
+
+
+def _load_histograms():
+    client = _get_redis()
+    if client is not None:
+        try:
+            histograms = {}
+            for key in client.scan_iter(REDIS_KEY_PREFIX + "*"):
+                key = key.decode() if isinstance(key, bytes) else key
+                values = client.hgetall(key)
+                histograms[key[len(REDIS_KEY_PREFIX):]] = {
+                    (field.decode() if isinstance(field, bytes) else field): float(value)
+                    for field, value in values.items()
+                }
+            return histograms
+        except Exception as e:
+            logger.warning(f"无法读取 Redis 指标: {e}")
+    with _local_lock:
+        return {stage: dict(histogram) for stage, histogram in _local_histograms.items()}
+
+
+def render_prometheus():
+    """
+    以 Prometheus 文本格式输出各阶段的耗时直方图。
+    """
+    lines = [
+        f"# HELP {METRIC_NAME} Duration of report generation stages.",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    for stage, histogram in sorted(_load_histograms().items()):
+        for field in [str(bound) for bound in STAGE_BUCKETS] + ["+Inf"]:
+            lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{field}"}} {int(histogram.get(field, 0))}')
+        lines.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {histogram.get("sum", 0.0)}')
+        lines.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {int(histogram.get("count", 0))}')
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def profiled(job_id, enabled=None):
+    """
+    enabled（默认取 REPORT_PROFILE）为真时，对代码块做 cProfile 分析并保存到 PROFILE_DIR/<job_id>.prof。
+    """
+    if enabled is None:
+        enabled = REPORT_PROFILE
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile_path = os.path.join(PROFILE_DIR, f"{job_id or int(time.time())}.prof")
+        profiler.dump_stats(profile_path)
+        logger.info(json.dumps({"event": "profile", "job": job_id, "path": profile_path}, ensure_ascii=False))
@@ -1,46 +1,163 @@
 import matplotlib
 matplotlib.use('Agg')  # Use a non-interactive backend suitable for Flask
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.ticker import MaxNLocator
+import io
 import os
+import threading
 
 # Set font properties to support Chinese characters
-plt.rcParams['font.sans-serif'] = ['Microsoft YaHei']  # Adjust as needed
-plt.rcParams['axes.unicode_minus'] = False  # Ensure minus signs display correctly
+matplotlib.rcParams['font.sans-serif'] = ['Microsoft YaHei']  # Adjust as needed
+matplotlib.rcParams['axes.unicode_minus'] = False  # Ensure minus signs display correctly
 
-def plot_distribution(distribution, title, file_path):
+# Resolution of the saved plot images
+PLOT_DPI = int(os.getenv("PLOT_DPI", "100"))
+
+_local = threading.local()
+
+
+class DistributionPlotter:
+    """
+    Renders score distribution bar charts on a single reusable figure.
+
+    The figure is built once with the object-oriented Figure/FigureCanvasAgg API (no pyplot
+    global state). Later plots with the same score ranges only update the bar heights and the
+    title. Each thread gets its own plotter through get_plotter(), so no locking is needed.
+    """
+
+    def __init__(self, dpi=PLOT_DPI):
+        self.figure = Figure(figsize=(10, 6), dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        self.labels = None
+        self.bars = None
+
+    def _build(self, labels, counts):
+        self.axes.clear()
+        self.bars = self.axes.bar(labels, counts, color='skyblue')
+        self.axes.set_xlabel('分数段')
+        self.axes.set_ylabel('人数')
+        self.axes.yaxis.set_major_locator(MaxNLocator(integer=True))
+        self.axes.grid(True)
+        self.labels = labels
+
+    def render(self, labels, counts, title, target):
+        if labels != self.labels:
+            self._build(labels, counts)
+        else:
+            for bar, count in zip(self.bars, counts):
+                bar.set_height(count)
+            self.axes.relim()
+            self.axes.autoscale_view()
+        self.axes.set_title(title)
+        self.figure.savefig(target, format='png')
+
+
+def get_plotter(dpi=PLOT_DPI):
+    """
+    Returns the current thread's plotter for the given DPI, creating it on first use.
+    """
+    plotters = getattr(_local, 'plotters', None)
+    if plotters is None:
+        plotters = _local.plotters = {}
+    if dpi not in plotters:
+        plotters[dpi] = DistributionPlotter(dpi)
+    return plotters[dpi]
+
+
+def _validate_distribution(distribution):
+    # Check if distribution has the correct structure
+    if not isinstance(distribution, dict) or not all(isinstance(d, dict) and '人数' in d for d in distribution.values()):
+        raise ValueError("Invalid distribution format: Expected a dictionary with '人数' key in each value.")
+
+
+def render_distribution(distribution, title, dpi=PLOT_DPI):
+    """
+    Plots a distribution of scores into an in-memory PNG.
+
+    Parameters:
+        distribution (dict): Same structure as for plot_distribution.
+        title (str): Title of the plot.
+        dpi (int): Resolution of the image.
+
+    Returns:
+        io.BytesIO: PNG image data, positioned at the start.
+    """
+    _validate_distribution(distribution)
+
+    scores = list(distribution.keys())
+    counts = [d['人数'] for d in distribution.values()]
+
+    buffer = io.BytesIO()
+    get_plotter(dpi).render(scores, counts, title, buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def plot_distribution(distribution, title, file_path, dpi=PLOT_DPI):
     """
     Plots a distribution of scores and saves it to the specified file path.
 
     Parameters:
         distribution (dict): Dictionary where keys are score ranges (e.g., '60-70') and
-                             values are dictionaries with '人数' (count of people) and 
+                             values are dictionaries with '人数' (count of people) and
                              possibly other statistics.
         title (str): Title of the plot.
         file_path (str): File path to save the plot image.
+        dpi (int): Resolution of the saved image.
     """
-    # Check if distribution has the correct structure
-    if not isinstance(distribution, dict) or not all(isinstance(d, dict) and '人数' in d for d in distribution.values()):
-        raise ValueError("Invalid distribution format: Expected a dictionary with '人数' key in each value.")
+    _validate_distribution(distribution)
 
     scores = list(distribution.keys())
     counts = [d['人数'] for d in distribution.values()]
-    
-    # Create the plot
-    plt.figure(figsize=(10, 6))
-    plt.bar(scores, counts, color='skyblue')
-    plt.xlabel('分数段')
-    plt.ylabel('人数')
-    plt.title(title)
-    plt.gca().yaxis.set_major_locator(MaxNLocator(integer=True))
-    plt.grid(True)
-    
+
     # Ensure the directory exists
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    
-    # Save the plot to the specified file path
-    plt.savefig(file_path)
-    plt.close()
-    
+
+    # Render on the reusable figure and save to the specified file path
+    get_plotter(dpi).render(scores, counts, title, file_path)
+
     # Return the file path for web access
     return file_path
+
+
+def render_grouped_distribution(distributions, title, dpi=PLOT_DPI):
+    """
+    Plots the distributions of several groups (e.g. classes) side by side as a grouped bar chart.
+
+    Parameters:
+        distributions (dict): Maps each group name to a distribution with the same structure as
+                              for plot_distribution. All distributions share the same score ranges.
+        title (str): Title of the plot.
+        dpi (int): Resolution of the image.
+
+    Returns:
+        io.BytesIO: PNG image data, positioned at the start.
+    """
+    for distribution in distributions.values():
+        _validate_distribution(distribution)
+
+    labels = list(next(iter(distributions.values())).keys()) if distributions else []
+    # The figure layout depends on the number of groups, so it is built per call instead of reusing a plotter
+    figure = Figure(figsize=(10, 6), dpi=dpi)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    width = 0.8 / max(len(distributions), 1)
+    for index, (group, distribution) in enumerate(distributions.items()):
+        positions = [i + (index - (len(distributions) - 1) / 2) * width for i in range(len(labels))]
+        axes.bar(positions, [d['人数'] for d in distribution.values()], width=width, label=str(group))
+    axes.set_xticks(range(len(labels)))
+    axes.set_xticklabels(labels)
+    axes.set_xlabel('分数段')
+    axes.set_ylabel('人数')
+    axes.yaxis.set_major_locator(MaxNLocator(integer=True))
+    axes.grid(True, axis='y')
+    if distributions:
+        axes.legend()
+    axes.set_title(title)
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,158 @@
+# report_cache.py
+"""
+已生成报告的缓存，按上传文件内容哈希、班级名称和报告风格索引。
+
+同一份成绩表以相同参数再次上传时，/process 直接返回已有报告的下载地址，不再排队生成。
+报告文件保存在共享存储（report_store）中，由 storage 模块管理其清理；这里只保存索引，
+登记的报告总大小超过 REPORT_CACHE_MAX_BYTES 时淘汰最久未访问的条目。
+
+索引由 worker 写入、web 进程读取，因此和任务登记表一样保存在 Redis 中：哈希
+report_cache:entries（缓存键 -> 报告信息）和按访问时间排序的有序集合 report_cache:lru。
+未配置 REDISCLOUD_URL 时保存在当前进程内存中（仅用于本地开发）。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+ENTRIES_KEY = "report_cache:entries"
+LRU_KEY = "report_cache:lru"
+
+
+def make_key(file_hash, class_name1, class_name2, report_style, group_by_class=False):
+    """
+    由文件内容哈希和影响报告内容的参数生成缓存键。
+    """
+    parts = [file_hash, class_name1, class_name2, report_style]
+    if group_by_class:
+        # 只在分班级统计时加入，不改变已有缓存条目的键
+        parts.append("group_by_class")
+    payload = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ReportCache:
+    """
+    已生成报告的缓存，超出总大小上限时按 LRU 淘汰。
+
+    参数：
+    - url: Redis 地址，为空时使用进程内存
+    - max_bytes: 缓存报告的总大小上限（字节）
+    """
+
+    def __init__(self, url, max_bytes):
+        self.url = url
+        self.max_bytes = max_bytes
+        self._redis = None
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def _client(self):
+        if not self.url:
+            return None
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(self.url)
+        return self._redis
+
+    def get(self, key):
+        """
+        返回 (报告的存储键, 下载文件名, 提示文字)，没有缓存时返回 None。
+        提示文字为首次生成时给用户的提示（见 data_processing.report_warning），没有时为 None。
+        """
+        client = self._client()
+        if client is None:
+            with self._lock:
+                entry = self._local.get(key)
+                if entry is None:
+                    return None
+                entry["accessed_at"] = time.time()
+                return entry["report_key"], entry["name"], entry.get("warning")
+        value = client.hget(ENTRIES_KEY, key)
+        if value is None:
+            return None
+        client.zadd(LRU_KEY, {key: time.time()})
+        entry = json.loads(value)
+        return entry["report_key"], entry["name"], entry.get("warning")
+
+    def put(self, key, report_key, name, size, warning=None):
+        """
+        登记一份已存入共享存储的报告及生成时的提示文字，然后淘汰超出大小上限的旧条目。
+        """
+        entry = {"report_key": report_key, "name": name, "size": size, "warning": warning}
+        client = self._client()
+        if client is None:
+            with self._lock:
+                self._local[key] = {**entry, "accessed_at": time.time()}
+                ordered = sorted(self._local, key=lambda old_key: self._local[old_key]["accessed_at"], reverse=True)
+                for old_key in self._evicted(ordered, self._local):
+                    del self._local[old_key]
+            return
+        pipeline = client.pipeline()
+        pipeline.hset(ENTRIES_KEY, key, json.dumps(entry, ensure_ascii=False))
+        pipeline.zadd(LRU_KEY, {key: time.time()})
+        pipeline.execute()
+        ordered = [old_key.decode() for old_key in client.zrevrange(LRU_KEY, 0, -1)]
+        entries = self._entries(client)
+        evicted = self._evicted(ordered, entries)
+        if evicted:
+            pipeline = client.pipeline()
+            pipeline.hdel(ENTRIES_KEY, *evicted)
+            pipeline.zrem(LRU_KEY, *evicted)
+            pipeline.execute()
+
+    def _evicted(self, ordered, entries):
+        # 从最近访问的报告开始累计大小，超出上限的部分全部淘汰
+        evicted = []
+        total = 0
+        for key in ordered:
+            total += entries[key]["size"] if key in entries else 0
+            if total > self.max_bytes:
+                evicted.append(key)
+        return evicted
+
+    @staticmethod
+    def _entries(client):
+        return {key.decode(): json.loads(value) for key, value in client.hgetall(ENTRIES_KEY).items()}
+
+    def discard(self, report_keys):
+        """
+        删除指向这些报告（已从存储中清理）的缓存条目。
+        """
+        if not report_keys:
+            return
+        report_keys = set(report_keys)
+        client = self._client()
+        if client is None:
+            with self._lock:
+                for key in [key for key, entry in self._local.items() if entry["report_key"] in report_keys]:
+                    del self._local[key]
+            return
+        stale = [key for key, entry in self._entries(client).items() if entry["report_key"] in report_keys]
+        if stale:
+            pipeline = client.pipeline()
+            pipeline.hdel(ENTRIES_KEY, *stale)
+            pipeline.zrem(LRU_KEY, *stale)
+            pipeline.execute()
+
+    def stats(self):
+        """
+        返回缓存的报告数和总大小。
+        """
+        client = self._client()
+        if client is None:
+            with self._lock:
+                entries = list(self._local.values())
+        else:
+            entries = list(self._entries(client).values())
+        return {
+            "entries": len(entries),
+            "bytes": sum(entry["size"] for entry in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+report_cache = ReportCache(os.getenv("REDISCLOUD_URL"), REPORT_CACHE_MAX_BYTES)
@@ -1,20 +1,32 @@
 # report_generation.py
 
+import io
 import logging
 import os
+import threading
+import time
 from docx import Document
 from docx.shared import Pt, Inches, Cm
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.oxml.ns import qn  # For Chinese font settings
 from docx.enum.section import WD_SECTION
-from ai_interface import call_with_messages  # Ensure this module is available
-from flask import session
-from celery import shared_task
-
-@shared_task
-def generate_report_task(*args, **kwargs):
-    # 调用 generate_word_report 函数
-    return generate_word_report(*args, **kwargs)
+from ai_interface import call_many, ai_backend, FAILURE_MESSAGES  # Ensure this module is available
+import metrics
+from section_store import section_store, fingerprint
+
+# 报告模板文件，不存在时使用 build_report_template() 生成的模板
+REPORT_TEMPLATE_PATH = os.getenv(
+    "REPORT_TEMPLATE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "report_template.docx")
+)
+
+_template_bytes = None
+_template_lock = threading.Lock()
+
+# AI 分析流式预览的最短上报间隔（秒）和预览的最大字数
+PREVIEW_INTERVAL = 0.5
+PREVIEW_MAX_CHARS = 300
+
 def set_paragraph_font(paragraph, size=10.5, name='SimSun'):
     """
     设置段落中所有Run对象的字体大小和字体名称。
@@ -52,7 +64,7 @@ def generate_score_table(doc, score_data, total_students, table_title, table_num
 
     参数：
     - doc: Document对象
-    - score_data: 单项成绩的数据字典，包括 'stats', 'distribution_text', 'plot_file_name' 等
+    - score_data: 单项成绩的数据字典，包括 'stats', 'distribution_text', 'plot_image' 或 'plot_file_name' 等
     - total_students: 总人数
     - table_title: 表格标题，如 "网络学习部分成绩情况表"
     - table_number: 表格编号，如 "表2"
@@ -158,10 +170,14 @@ def generate_score_table(doc, score_data, total_students, table_title, table_num
     # 合并第二列到第十一列
     row5 = table.rows[4]
     row5.cells[1].merge(row5.cells[10])
-    if score_data and 'plot_file_name' in score_data:
+    # 优先使用内存中的图片（plot_image），其次使用图片文件路径（plot_file_name）
+    plot_source = score_data.get('plot_image') or score_data.get('plot_file_name') if score_data else None
+    if plot_source:
         try:
+            if hasattr(plot_source, 'seek'):
+                plot_source.seek(0)
             run = table.cell(4, 1).paragraphs[0].add_run()
-            run.add_picture(score_data['plot_file_name'], width=Inches(6))
+            run.add_picture(plot_source, width=Inches(6))
         except Exception as e:
             table.cell(4, 1).text = "图片插入失败"
     else:
@@ -178,22 +194,74 @@ def generate_score_table(doc, score_data, total_students, table_title, table_num
                     set_paragraph_font(paragraph, size=10.5, name='SimSun')
 
 
-def generate_word_report(
-    base_name,
-    output_file_name,
-    all_scores_data,
-    output_path,
-    semester_info,
-    course_name,
-    total_students,
-    class_name1,
-    class_name2=None,  # Set default value to None
-    report_style="formal"
-):
-    # Initialize session progress tracking
-    ##session[session_id]["progress"] = 80  # Assuming previous steps covered up to 80%
-    ##session[session_id]["status"] = "Generating report..."
+def generate_class_comparison_table(doc, score_data, table_title, table_number):
+    """
+    生成分班级对比表：每个班级一行，与合计并排列出人数、最高分、最低分、平均分和各分数段的人数（占比），
+    表格最后一行为各班级并排的成绩分布图。
+
+    参数：
+    - doc: Document对象
+    - score_data: 单项成绩的数据字典，包括合并的 'stats'、'distribution_plot'，
+      分班级的 'class_statistics'（{班级: (stats, distribution_text, distribution_plot)}）和 'class_plot_image'
+    - table_title: 表格标题，如 "网络学习部分各班级成绩对比表"
+    - table_number: 表格编号，如 "表2-1"
+    """
+    table_title_paragraph = doc.add_paragraph()
+    table_title_paragraph.paragraph_format.first_line_indent = Pt(21)  # 缩进两个字符
+    table_title_run = table_title_paragraph.add_run(f"{table_number}  {table_title}")
+    table_title_run.font.size = Pt(9)
+    table_title_run.font.name = 'SimSun'
+    table_title_run.bold = True
+
+    segments = list(score_data['distribution_plot'].keys())
+    rows = [(name, stats, distribution_plot) for name, (stats, _, distribution_plot) in score_data['class_statistics'].items()]
+    rows.append(("合计", score_data['stats'], score_data['distribution_plot']))
+
+    n_columns = 5 + len(segments)
+    table = doc.add_table(rows=len(rows) + 2, cols=n_columns)
+    table.style = 'Table Grid'
+    table.autofit = False
+
+    headers = ["班级", "人数", "最高分", "最低分", "平均分"] + segments
+    for idx, header in enumerate(headers):
+        table.cell(0, idx).text = header
+    for row_idx, (name, stats, distribution_plot) in enumerate(rows, start=1):
+        table.cell(row_idx, 0).text = str(name)
+        table.cell(row_idx, 1).text = str(stats['总人数'])
+        table.cell(row_idx, 2).text = str(stats['最高分'])
+        table.cell(row_idx, 3).text = str(stats['最低分'])
+        table.cell(row_idx, 4).text = str(stats['平均分'])
+        for idx, values in enumerate(distribution_plot.values()):
+            table.cell(row_idx, 5 + idx).text = f"{values['人数']}（{values['占比']:.2f}%）"
+
+    # 最后一行：各班级并排的成绩分布图
+    plot_row = len(rows) + 1
+    plot_cell = table.cell(plot_row, 0).merge(table.cell(plot_row, n_columns - 1))
+    plot_image = score_data.get('class_plot_image')
+    if plot_image is not None:
+        try:
+            plot_image.seek(0)
+            plot_cell.paragraphs[0].add_run().add_picture(plot_image, width=Inches(6))
+        except Exception as e:
+            logging.error(f"Unable to add class comparison plot: {e}")
+            plot_cell.text = "图片插入失败"
+    else:
+        plot_cell.text = "N/A"
 
+    for row in table.rows:
+        for cell in row.cells:
+            for paragraph in cell.paragraphs:
+                paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                set_paragraph_font(paragraph, size=9, name='SimSun')
+
+
+def build_report_template():
+    """
+    构建报告的固定部分（页眉图标、标题、教学基本信息、考核说明和表1），返回Document对象。
+
+    学期、课程名称和授课对象以 {{semester_info}}、{{course_name}}、{{class_info}} 占位，
+    由 fill_placeholders 在生成每份报告时替换。
+    """
     # 创建 Word 文档
     doc = Document()
 
@@ -230,14 +298,14 @@ def generate_word_report(
     # 第二行：居中Times New Roman 10.5号字，内容是学期信息
     semester_paragraph = doc.add_paragraph()
     semester_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    semester_run = semester_paragraph.add_run(f'({semester_info})')
+    semester_run = semester_paragraph.add_run('({{semester_info}})')
     semester_run.font.size = Pt(10.5)
     semester_run.font.name = 'Times New Roman'
 
     # 第二行：居中Times New Roman 10.5号字，内容是学期信息
     semester_paragraph = doc.add_paragraph()
     semester_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    semester_run = semester_paragraph.add_run('('+semester_info+')')
+    semester_run = semester_paragraph.add_run('({{semester_info}})')
     semester_run.font.size = Pt(10.5)
     semester_run.font.name = 'Times New Roman'
 
@@ -252,20 +320,13 @@ def generate_word_report(
     # 第四行：缩进两个字符，10.5号SimSun字，写"课程名称：" + course_name
     course_paragraph = doc.add_paragraph()
     course_paragraph.paragraph_format.first_line_indent = Pt(21)  # 缩进两个字符（约21pt）
-    course_run = course_paragraph.add_run(f"课程名称：{course_name}")
+    course_run = course_paragraph.add_run("课程名称：{{course_name}}")
     set_paragraph_font(course_paragraph, size=10.5, name='SimSun')
 
-    # 第五行：缩进两个字符，10.5号SimSun字，写"授课对象及合班情况：" + total_students
-    if class_name1 and class_name2:
-        class_info = f"{class_name1}和{class_name2}，共计{total_students}人"
-    elif class_name1:
-        class_info = f"{class_name1}，共计{total_students}人"
-    else:
-        class_info = f"共计{total_students}人"  # 如果没有输入班级名称
-    
+    # 第五行：缩进两个字符，10.5号SimSun字，写"授课对象及合班情况：" + class_info
     student_paragraph = doc.add_paragraph()
     student_paragraph.paragraph_format.first_line_indent = Pt(21)  # 缩进两个字符
-    student_run = student_paragraph.add_run(f"授课对象及合班情况：{class_info}")
+    student_run = student_paragraph.add_run("授课对象及合班情况：{{class_info}}")
     set_paragraph_font(student_paragraph, size=10.5, name='SimSun')
 
     prof_paragraph = doc.add_paragraph()
@@ -377,9 +438,228 @@ def generate_word_report(
                     run.font.size = Pt(9)
                     run.font.name = 'SimSun'
 
-    # With session updates:
-    ##session[session_id]["progress"] += 5
-    ##session[session_id]["status"] = f"Generating {score_type} score report..."
+    return doc
+
+def export_report_template(path=REPORT_TEMPLATE_PATH):
+    """
+    将程序生成的报告模板保存为 .docx 文件，之后可以直接在 Word 中编辑版式。
+    """
+    build_report_template().save(path)
+    return path
+
+def load_report_template():
+    """
+    返回报告模板的一份新副本。模板在每个进程中只读取（或构建）一次，之后每份报告从内存中的
+    模板数据复制。存在 REPORT_TEMPLATE_PATH 文件时使用该文件，否则使用程序生成的模板。
+    """
+    global _template_bytes
+    if _template_bytes is None:
+        with _template_lock:
+            if _template_bytes is None:
+                if os.path.isfile(REPORT_TEMPLATE_PATH):
+                    with open(REPORT_TEMPLATE_PATH, 'rb') as template_file:
+                        _template_bytes = template_file.read()
+                else:
+                    buffer = io.BytesIO()
+                    build_report_template().save(buffer)
+                    _template_bytes = buffer.getvalue()
+    return Document(io.BytesIO(_template_bytes))
+
+def fill_placeholders(doc, values):
+    """
+    用 values 中的值替换文档正文（包括表格）中的 {{key}} 占位符，保留原有格式。
+    """
+    def paragraphs():
+        yield from doc.paragraphs
+        for table in doc.tables:
+            for row in table.rows:
+                for cell in row.cells:
+                    yield from cell.paragraphs
+
+    for paragraph in paragraphs():
+        if '{{' not in paragraph.text:
+            continue
+        for run in paragraph.runs:
+            for key, value in values.items():
+                run.text = run.text.replace('{{' + key + '}}', str(value))
+        # 在 Word 中编辑过的模板可能把占位符拆成多个 run，此时合并到第一个 run 中
+        if any('{{' + key + '}}' in paragraph.text for key in values):
+            text = paragraph.text
+            for key, value in values.items():
+                text = text.replace('{{' + key + '}}', str(value))
+            paragraph.runs[0].text = text
+            for run in paragraph.runs[1:]:
+                run.text = ''
+
+def build_score_analysis_prompt(score_type, stats, distribution_text, report_style, class_statistics=None):
+    """
+    构造单项成绩分析的提示词。给出 class_statistics（分班级统计）时附上各班级的概况，便于比较各班级。
+    """
+    distribution_description = ""
+    for range_key, values in distribution_text.items():
+        distribution_description += f"{range_key}: 人数 {values['人数']}, 占比 {values['占比']:.2f}%；"
+    class_description = ""
+    if class_statistics:
+        class_description = "各班级的情况如下：" + "".join(
+            f"{name}: 人数 {class_stats['总人数']}, 最高分 {class_stats['最高分']}, "
+            f"最低分 {class_stats['最低分']}, 平均分 {class_stats['平均分']}；"
+            for name, (class_stats, _, _) in class_statistics.items()
+        )
+
+    return (
+        f"请用 '{report_style}' 语言风格撰写报告分析。"
+        f"你作为这门课的授课老师，正在写校方布置的课程总结报告，对该门课学生{score_type}的成绩做出简要的书面总结和分析(除非学生成绩数据比较特殊，否则请不要过多的展示各分数段的总结和过分的罗列数值，而是稍微宏观一些做出总结)。"
+        f"以下为学生的成绩数据: 总人数为{stats['总人数']}，最高分为{stats['最高分']}，最低分为{stats['最低分']}，平均分为{stats['平均分']}。"
+        f"各分数段的分布情况如下：{distribution_description}"
+        f"{class_description}"
+        "备注：生成的内容中要大幅减少转接词的使用（例如首先、其次、最后、综上所述、总的来说、此外、值得XX的是、XXXX的是）。"
+        "同时要保证生成的内容通俗易懂，不晦涩，不要用太书面化的词语。"
+    )
+
+def build_learning_effectiveness_prompt(report_style):
+    """
+    构造学习成效分析的提示词。
+    """
+    return (
+        "（然后从下面的方面进行分析："
+        f"请用 '{report_style}' 语言风格撰写报告分析。"
+        "1、学习本课程之前学生的课程基础的掌握情况；"
+        "2、学习本课程时，学生的学习态度情况（如提问情况、主动性）；"
+        "3、课时安排对教学效果的影响；"
+        "4、教学方式对教学效果的影响；"
+        "5、教学内容对教学效果的影响。）"
+        "请注意，分析内容不要过于细节，可以适当使用较为概括和笼统的语言。"
+    )
+
+def build_suggestion_prompt(report_style):
+    """
+    构造改进措施及建议的提示词。
+    """
+    return (
+        f"请用 '{report_style}' 语言风格撰写报告分析。"
+        "请写出几条针对这个课程方方面面都可以的改进措施及建议。"
+        "请注意，分析内容不要过于细节，可以适当使用较为概括和笼统的语言。"
+    )
+
+def generate_word_report(
+    base_name,
+    output_file_name,
+    all_scores_data,
+    output_path,
+    semester_info,
+    course_name,
+    total_students,
+    class_name1,
+    class_name2=None,  # Set default value to None
+    report_style="formal",
+    use_cache=True,
+    progress_callback=None,
+    job_id=None,
+    build_key=None,
+    previous_sections=None
+):
+    """
+    生成 Word 报告。progress_callback(progress, status, **extra) 可选，用于在各 AI 分析完成和保存文档时
+    报告进度；AI 分析生成过程中还会通过 extra 中的 preview 上报正在生成的文本预览。
+
+    给出 build_key（见 section_store.course_key）时记录每个 AI 分析部分的指纹和文字；
+    previous_sections 为该课程上一次生成的部分，指纹相同的 AI 分析直接复用，不再请求。
+
+    score_data 中有 class_statistics（分班级统计）时，在该项成绩的表格后附上各班级的对比表和对比图。
+    """
+    def report_progress(progress, status, **extra):
+        if progress_callback is not None:
+            progress_callback(progress, status, **extra)
+
+    # 各部分的 AI 分析互不依赖，先一次性并发请求，再按文档顺序取用结果
+    # 两个总体分析沿用原来的默认风格（formal）
+    ai_requests = [
+        (
+            build_score_analysis_prompt(
+                score_data['score_type'], score_data['stats'], score_data['distribution_text'], report_style,
+                score_data.get('class_statistics')
+            ),
+            report_style,
+        )
+        for score_data in all_scores_data
+    ]
+    ai_requests.append((build_learning_effectiveness_prompt(report_style), 'formal'))
+    ai_requests.append((build_suggestion_prompt(report_style), 'formal'))
+    ai_section_names = [f"{score_data['score_type']}成绩分析" for score_data in all_scores_data]
+    ai_section_names += ["学习成效分析", "改进措施及建议"]
+
+    # 提示词和模型都没有变化的部分复用上一次生成的文字，只请求发生变化的部分
+    ai_fingerprints = [fingerprint(ai_backend.model, content, style) for content, style in ai_requests]
+    ai_results = [None] * len(ai_requests)
+    for index, name in enumerate(ai_section_names):
+        previous = (previous_sections or {}).get(f"ai:{name}")
+        if previous is not None and previous[0] == ai_fingerprints[index]:
+            ai_results[index] = previous[1]
+    changed = [index for index, result in enumerate(ai_results) if result is None]
+    reused_sections = [ai_section_names[index] for index, result in enumerate(ai_results) if result is not None]
+
+    ai_status = "正在生成 AI 分析..."
+    if reused_sections:
+        ai_status = f"正在生成 AI 分析（{len(reused_sections)} 个部分未变化，沿用上次的分析）..."
+    progress_state = {'progress': 50, 'status': ai_status, 'preview_time': 0.0}
+    progress_lock = threading.Lock()
+
+    def on_ai_result(position, result):
+        # AI 分析占总进度的 50% 到 90%
+        with progress_lock:
+            progress_state['progress'] = 50 + int(40 * (position + 1) / len(changed))
+            progress_state['status'] = f"已完成 AI 分析：{ai_section_names[changed[position]]} ({position + 1}/{len(changed)})"
+            report_progress(progress_state['progress'], progress_state['status'])
+
+    def on_ai_partial(position, text):
+        # 流式输出的文本预览，限制上报频率
+        now = time.monotonic()
+        with progress_lock:
+            if now - progress_state['preview_time'] < PREVIEW_INTERVAL:
+                return
+            progress_state['preview_time'] = now
+            report_progress(
+                progress_state['progress'],
+                progress_state['status'],
+                preview={'section': ai_section_names[changed[position]], 'text': text[-PREVIEW_MAX_CHARS:]}
+            )
+
+    report_progress(50, ai_status)
+    changed_results = call_many(
+        [ai_requests[index] for index in changed],
+        use_cache=use_cache,
+        on_result=on_ai_result,
+        on_partial=on_ai_partial if progress_callback is not None else None,
+        job_id=job_id,
+        section_names=[ai_section_names[index] for index in changed]
+    )
+    for index, result in zip(changed, changed_results):
+        ai_results[index] = result
+        if build_key is not None and result not in FAILURE_MESSAGES:
+            section_store.save(build_key, f"ai:{ai_section_names[index]}", ai_fingerprints[index], result)
+    # AI 服务失败或熔断的部分先写入提示文字，并在返回值中列出。这些部分不写入 section_store，
+    # 重新生成该报告时其余部分直接复用，只重新请求这些部分
+    pending_ai_sections = [name for name, result in zip(ai_section_names, ai_results) if result in FAILURE_MESSAGES]
+    ai_score_results = ai_results[:len(all_scores_data)]
+    ai_learning_effectiveness_result, ai_suggestion_result = ai_results[len(all_scores_data):]
+
+    # 第五行的授课对象及合班情况
+    if class_name1 and class_name2:
+        class_info = f"{class_name1}和{class_name2}，共计{total_students}人"
+    elif class_name1:
+        class_info = f"{class_name1}，共计{total_students}人"
+    else:
+        class_info = f"共计{total_students}人"  # 如果没有输入班级名称
+
+    docx_build_start = time.perf_counter()
+
+    # 从模板复制报告的固定部分并填写占位符
+    doc = load_report_template()
+    fill_placeholders(doc, {
+        'semester_info': semester_info,
+        'course_name': course_name,
+        'class_info': class_info,
+    })
 
     # Loop through score data and generate content
     table_number = 2  # Starting table number
@@ -485,22 +765,16 @@ def generate_word_report(
             table_title=table_title,
             table_number=f"表{table_number}"
         )
-        # Generate AI-generated analysis
-        stats = score_data['stats']
-        distribution_text = score_data['distribution_text']
-        distribution_description = ""
-        for range_key, values in distribution_text.items():
-            distribution_description += f"{range_key}: 人数 {values['人数']}, 占比 {values['占比']:.2f}%；"
-
-        analysis_content = (
-            f"请用 '{report_style}' 语言风格撰写报告分析。"
-            f"你作为这门课的授课老师，正在写校方布置的课程总结报告，对该门课学生{score_type}的成绩做出简要的书面总结和分析(除非学生成绩数据比较特殊，否则请不要过多的展示各分数段的总结和过分的罗列数值，而是稍微宏观一些做出总结)。"
-            f"以下为学生的成绩数据: 总人数为{stats['总人数']}，最高分为{stats['最高分']}，最低分为{stats['最低分']}，平均分为{stats['平均分']}。"
-            f"各分数段的分布情况如下：{distribution_description}"
-            "备注：生成的内容中要大幅减少转接词的使用（例如首先、其次、最后、综上所述、总的来说、此外、值得XX的是、XXXX的是）。"
-            "同时要保证生成的内容通俗易懂，不晦涩，不要用太书面化的词语。"
-        )
-        ai_result = call_with_messages(analysis_content, report_style)
+        # 分班级统计时，在合并统计的表格后附上各班级的对比表
+        if score_data.get('class_statistics'):
+            generate_class_comparison_table(
+                doc=doc,
+                score_data=score_data,
+                table_title=table_title.replace("成绩情况表", "各班级成绩对比表"),
+                table_number=f"表{table_number}-1"
+            )
+        # AI-generated analysis (requested concurrently above)
+        ai_result = ai_score_results[idx]
 
         # 添加分析结果
         analysis_heading = doc.add_paragraph()
@@ -515,10 +789,6 @@ def generate_word_report(
         analysis_paragraph.paragraph_format.left_indent = Pt(21)
         set_paragraph_font(analysis_paragraph, size=10.5, name='SimSun')
 
-        # Update progress
-        ##session[session_id]["progress"] += 5
-        ##session[session_id]["status"] = f"Generating {score_type} score report..."
-
         table_number += 1  # Update table number
 
     # 添加学习成效分析
@@ -538,20 +808,6 @@ def generate_word_report(
     )
     set_paragraph_font(learning_intro_paragraph, size=10.5, name='SimSun')
 
-    # 调用 AI 接口生成学习成效分析
-    learning_effectiveness_content = (
-        "（然后从下面的方面进行分析："
-        f"请用 '{report_style}' 语言风格撰写报告分析。"
-        "1、学习本课程之前学生的课程基础的掌握情况；"
-        "2、学习本课程时，学生的学习态度情况（如提问情况、主动性）；"
-        "3、课时安排对教学效果的影响；"
-        "4、教学方式对教学效果的影响；"
-        "5、教学内容对教学效果的影响。）"
-        "请注意，分析内容不要过于细节，可以适当使用较为概括和笼统的语言。"
-        
-    )
-    ai_learning_effectiveness_result = call_with_messages(learning_effectiveness_content)
-
     # 添加AI生成的学习成效分析
     cleaned_ai_learning_effectiveness_result = ai_learning_effectiveness_result.replace("#", "").replace("*", "")
     learning_paragraph = doc.add_paragraph(cleaned_ai_learning_effectiveness_result)
@@ -567,29 +823,21 @@ def generate_word_report(
     suggestion_heading_run.font.name = 'SimSun'
     suggestion_heading.alignment = WD_ALIGN_PARAGRAPH.LEFT
 
-    # 调用 AI 接口生成改进措施及建议
-    suggestion_content = (
-        f"请用 '{report_style}' 语言风格撰写报告分析。"
-        "请写出几条针对这个课程方方面面都可以的改进措施及建议。"
-        "请注意，分析内容不要过于细节，可以适当使用较为概括和笼统的语言。"
-        
-    )
-    ai_suggestion_result = call_with_messages(suggestion_content)
-
     # 添加AI生成的改进措施及建议
     cleaned_ai_suggestion_result = ai_suggestion_result.replace("#", "").replace("*", "")
     suggestion_paragraph = doc.add_paragraph(cleaned_ai_suggestion_result)
     suggestion_paragraph.paragraph_format.left_indent = Pt(21)
     set_paragraph_font(suggestion_paragraph, size=10.5, name='SimSun')
 
-    # Update progress to 100%
-    ##session[session_id]["progress"] = 100
-    ##session[session_id]["status"] = "Report generation completed"
+    metrics.record("docx_build", time.perf_counter() - docx_build_start, job_id)
 
-    
-    doc.save(output_file_name)
+    report_progress(95, "正在保存报告...")
+    with metrics.span("save", job_id):
+        doc.save(output_file_name)
 
     return {
         "status": "success",
         "report_path": output_file_name,
+        "pending_ai_sections": pending_ai_sections,
+        "reused_sections": reused_sections,
     }
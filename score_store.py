@@ -0,0 +1,135 @@
+# score_store.py
+"""
+清洗后的成绩和各列统计数据的列式存储（Parquet），用于跨课程、跨学期的统计分析。
+
+每次生成报告时写入两份数据，均按课程和学期分区（hive 风格目录 course=.../semester=...），
+文件以数据集 ID（由上传文件的内容哈希和工作表名称生成，每个工作表一个）命名，
+同一份成绩表重复上传，无论合并生成还是按工作表生成，都只会覆盖相同的文件：
+
+- scores：每个学生一行，只保存各成绩列，不保存姓名、学号等个人信息；
+- stats：每种成绩一行，包括人数、最高分、最低分、平均分和 10 个分数段的人数。
+
+查询只读取 Parquet 文件，并按分区过滤，不需要重新解析 Excel。需要安装 pyarrow。
+"""
+
+import os
+import re
+import numpy as np
+import pandas as pd
+
+SCORE_STORE_DIR = os.getenv("SCORE_STORE_DIR", os.path.join("instance", "score_store"))
+SCORES_DATASET = "scores"
+STATS_DATASET = "stats"
+# stats 中 10 个分数段人数的列名：bin_0（0-10 分）到 bin_9（90-100 分）
+BIN_COLUMNS = [f"bin_{i}" for i in range(10)]
+PARTITION_COLUMNS = ["course", "semester"]
+
+
+def _partition_value(value):
+    # 分区值会成为目录名，去掉路径分隔符等字符
+    value = re.sub(r'[\\/:*?"<>|=]', "_", str(value or "").strip())
+    return value or "unknown"
+
+
+def _partition_dir(root, dataset, course, semester):
+    return os.path.join(
+        root, dataset, f"course={_partition_value(course)}", f"semester={_partition_value(semester)}"
+    )
+
+
+def _write(frame, root, dataset, course, semester, dataset_id):
+    directory = _partition_dir(root, dataset, course, semester)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{dataset_id}.parquet")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    frame.to_parquet(temp_path, engine="pyarrow", index=False)
+    os.replace(temp_path, path)
+
+
+def save_scores(dataset_id, course, semester, class_name, df, all_statistics, root=SCORE_STORE_DIR):
+    """
+    保存一次报告的清洗后成绩和统计数据。
+
+    参数：
+    - dataset_id: 数据集 ID，同一 ID 再次保存时覆盖
+    - course, semester: 课程名称和学期，用作分区
+    - class_name: 授课班级，写入每一行便于按班级筛选
+    - df: 清洗后的成绩表，只保存 all_statistics 中出现的成绩列
+    - all_statistics: calculate_all_statistics 的返回值
+    """
+    score_columns = list(all_statistics)
+    scores = df[score_columns].astype(np.float32).reset_index(drop=True)
+    scores.insert(0, "class_name", class_name)
+    scores.insert(0, "dataset", dataset_id)
+
+    rows = []
+    for score_type, (stats, distribution_text, _) in all_statistics.items():
+        row = {
+            "dataset": dataset_id,
+            "class_name": class_name,
+            "score_type": score_type,
+            "total": int(stats['总人数']),
+            "max": float(stats['最高分']),
+            "min": float(stats['最低分']),
+            "mean": float(stats['平均分']),
+        }
+        for column, values in zip(BIN_COLUMNS, distribution_text.values()):
+            row[column] = int(values['人数'])
+        rows.append(row)
+
+    _write(scores, root, SCORES_DATASET, course, semester, dataset_id)
+    _write(pd.DataFrame(rows), root, STATS_DATASET, course, semester, dataset_id)
+
+
+def _read(dataset, courses=None, semesters=None, root=SCORE_STORE_DIR):
+    path = os.path.join(root, dataset)
+    if not os.path.isdir(path):
+        return None
+    filters = []
+    if courses:
+        filters.append(("course", "in", [_partition_value(course) for course in courses]))
+    if semesters:
+        filters.append(("semester", "in", [_partition_value(semester) for semester in semesters]))
+    frame = pd.read_parquet(path, engine="pyarrow", filters=filters or None)
+    for column in PARTITION_COLUMNS:
+        if column in frame:
+            frame[column] = frame[column].astype(str)
+    return frame
+
+
+def load_scores(courses=None, semesters=None, root=SCORE_STORE_DIR):
+    """
+    读取学生成绩（每个学生一行），可按课程和学期筛选。没有数据时返回空 DataFrame。
+    """
+    frame = _read(SCORES_DATASET, courses, semesters, root)
+    return frame if frame is not None else pd.DataFrame(columns=["dataset", "class_name", *PARTITION_COLUMNS])
+
+
+def load_stats(courses=None, semesters=None, root=SCORE_STORE_DIR):
+    """
+    读取各数据集每种成绩的统计数据，可按课程和学期筛选。没有数据时返回空 DataFrame。
+    """
+    frame = _read(STATS_DATASET, courses, semesters, root)
+    columns = ["dataset", "class_name", "score_type", "total", "max", "min", "mean", *BIN_COLUMNS, *PARTITION_COLUMNS]
+    return frame if frame is not None else pd.DataFrame(columns=columns)
+
+
+def aggregate_stats(stats, group_by=("course", "semester")):
+    """
+    按 group_by 和成绩类型汇总统计数据：人数和各分数段人数相加，最高分、最低分取极值，
+    平均分按人数加权。只用到已保存的统计数据，不读取学生成绩。
+    """
+    keys = [*group_by, "score_type"]
+    if stats.empty:
+        return pd.DataFrame(columns=[*keys, "datasets", "total", "max", "min", "mean", *BIN_COLUMNS])
+    weighted = stats.assign(weighted_sum=stats["mean"] * stats["total"])
+    grouped = weighted.groupby(keys, sort=True).agg(
+        datasets=("dataset", "nunique"),
+        total=("total", "sum"),
+        max=("max", "max"),
+        min=("min", "min"),
+        weighted_sum=("weighted_sum", "sum"),
+        **{column: (column, "sum") for column in BIN_COLUMNS},
+    )
+    grouped["mean"] = (grouped["weighted_sum"] / grouped["total"].where(grouped["total"] > 0)).round(2)
+    return grouped.reset_index()[[*keys, "datasets", "total", "max", "min", "mean", *BIN_COLUMNS]]
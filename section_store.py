@@ -0,0 +1,103 @@
+# section_store.py
+"""
+报告各部分的指纹和产物，用于增量重新生成。
+
+每门课程（学期、课程名称和班级）保存上一次生成时每个部分的输入指纹及其产物：
+每种成绩的分布图（PNG）和每个 AI 分析部分的文字。再次生成时，指纹没有变化的部分
+直接复用上一次的产物，只重新计算输入发生变化的部分。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SECTION_STORE_PATH = os.getenv("SECTION_STORE_PATH", os.path.join("instance", "section_store.db"))
+# 超过该时间（秒）没有再生成过的课程，其保存的部分会被清理
+SECTION_STORE_TTL = int(os.getenv("SECTION_STORE_TTL", str(30 * 24 * 3600)))
+
+
+def fingerprint(*parts):
+    """
+    由一个部分的全部输入计算指纹。parts 需能序列化为 JSON（numpy 数值按字符串处理）。
+    """
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def course_key(semester_info, course_name, class_name1, class_name2, sheet_name=None):
+    """
+    标识"同一门课程"的键，同一课程的再次上传会与上一次生成的结果比较。
+    每个工作表单独生成报告时，各工作表分别比较。
+    """
+    if sheet_name is not None:
+        return fingerprint(semester_info, course_name, class_name1, class_name2 or "", sheet_name)
+    return fingerprint(semester_info, course_name, class_name1, class_name2 or "")
+
+
+class SectionStore:
+    """
+    基于 SQLite 保存每门课程上一次生成时各部分的指纹和产物。
+
+    参数：
+    - path: 数据库文件路径
+    - ttl: 课程条目的有效期（秒）
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS report_sections ("
+                "course TEXT NOT NULL, section TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+                "payload BLOB NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (course, section))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def load(self, course):
+        """
+        返回该课程上一次生成的 {部分名称: (指纹, 产物)}，并刷新这些条目的有效期。
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT section, fingerprint, payload FROM report_sections WHERE course = ? AND updated_at >= ?",
+                (course, now - self.ttl),
+            ).fetchall()
+            conn.execute(
+                "UPDATE report_sections SET updated_at = ? WHERE course = ? AND updated_at >= ?",
+                (now, course, now - self.ttl),
+            )
+            conn.commit()
+        return {section: (section_fingerprint, payload) for section, section_fingerprint, payload in rows}
+
+    def save(self, course, section, section_fingerprint, payload):
+        """
+        记录某一部分本次生成的指纹和产物（bytes 或 str），同时清理过期的条目。
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO report_sections (course, section, fingerprint, payload, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (course, section, section_fingerprint, payload, now),
+            )
+            conn.execute("DELETE FROM report_sections WHERE updated_at < ?", (now - self.ttl,))
+            conn.commit()
+
+
+section_store = SectionStore(SECTION_STORE_PATH, SECTION_STORE_TTL)
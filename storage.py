@@ -0,0 +1,205 @@
+# storage.py
+"""
+上传文件和生成结果的存储管理。
+
+上传的成绩表存入 blob_store，生成的报告和批量打包文件存入 report_store（本地存储时为
+GENERATED_REPORTS 目录，按哈希前两位分目录）。每个文件的大小、写入时间和最近访问时间记录在
+索引中，后台清理任务（Celery beat 定时运行 sweep_storage_task）删除超过 STORAGE_TTL 未被访问的
+文件，并在总大小超过 STORAGE_QUOTA_BYTES 时按最久未访问的顺序继续删除。
+
+上传和下载在 web 进程中登记，生成结果和清理在 worker 中进行，因此索引和任务登记表一样保存在
+Redis 中：哈希 storage:files（文件 -> 存储、大小和写入时间）和按访问时间排序的有序集合
+storage:lru。未配置 REDISCLOUD_URL 时保存在当前进程内存中（仅用于本地开发）。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from celery import shared_task
+from blob_store import blob_store, report_store, put_file
+from report_cache import report_cache
+
+# 文件在最近一次访问后保留的时间（秒）和所有文件的总大小上限（字节）
+STORAGE_TTL = int(os.getenv("STORAGE_TTL", str(7 * 24 * 3600)))
+STORAGE_QUOTA_BYTES = int(os.getenv("STORAGE_QUOTA_BYTES", str(2 * 1024 * 1024 * 1024)))
+# 后台清理的间隔（秒）
+STORAGE_SWEEP_INTERVAL = int(os.getenv("STORAGE_SWEEP_INTERVAL", "3600"))
+
+UPLOADS = "uploads"
+REPORTS = "reports"
+STORES = {UPLOADS: blob_store, REPORTS: report_store}
+FILES_KEY = "storage:files"
+LRU_KEY = "storage:lru"
+
+logger = logging.getLogger(__name__)
+
+
+class _CountingReader:
+    # 包装上传的文件流，统计写入存储的字节数
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        return data
+
+
+class StorageIndex:
+    """
+    记录每个存储文件的大小和访问时间。
+
+    参数：
+    - url: Redis 地址，为空时使用进程内存
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._redis = None
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def _client(self):
+        if not self.url:
+            return None
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(self.url)
+        return self._redis
+
+    @staticmethod
+    def _member(store, key):
+        return f"{store}:{key}"
+
+    def record(self, store, key, size):
+        """
+        登记一个写入存储的文件。内容相同的文件再次写入时只刷新访问时间。
+        """
+        now = time.time()
+        member = self._member(store, key)
+        entry = {"store": store, "key": key, "size": size, "created_at": now}
+        client = self._client()
+        if client is None:
+            with self._lock:
+                self._local.setdefault(member, entry)["accessed_at"] = now
+            return
+        pipeline = client.pipeline()
+        pipeline.hsetnx(FILES_KEY, member, json.dumps(entry, ensure_ascii=False))
+        pipeline.zadd(LRU_KEY, {member: now})
+        pipeline.execute()
+
+    def touch(self, store, key):
+        now = time.time()
+        member = self._member(store, key)
+        client = self._client()
+        if client is None:
+            with self._lock:
+                if member in self._local:
+                    self._local[member]["accessed_at"] = now
+            return
+        # 只刷新已登记的文件，xx=True 不会为未登记的键新增条目
+        client.zadd(LRU_KEY, {member: now}, xx=True)
+
+    def _entries(self, client):
+        # 返回 [(文件, 登记信息, 访问时间)]，按最近访问的顺序排列
+        if client is None:
+            with self._lock:
+                entries = [(member, entry, entry["accessed_at"]) for member, entry in self._local.items()]
+            return sorted(entries, key=lambda item: item[2], reverse=True)
+        files = client.hgetall(FILES_KEY)
+        return [
+            (member.decode(), json.loads(files[member]), accessed_at)
+            for member, accessed_at in client.zrevrange(LRU_KEY, 0, -1, withscores=True)
+            if member in files
+        ]
+
+    def expired(self, ttl, quota_bytes):
+        """
+        从索引中删除超过 ttl 未访问的文件以及超出 quota_bytes 的最久未访问文件，返回被删除的 (store, key)。
+        """
+        now = time.time()
+        client = self._client()
+        removed = {}
+        total = 0
+        for member, entry, accessed_at in self._entries(client):
+            total += entry["size"]
+            if accessed_at < now - ttl or total > quota_bytes:
+                removed[member] = (entry["store"], entry["key"])
+        if client is None:
+            with self._lock:
+                for member in removed:
+                    self._local.pop(member, None)
+        elif removed:
+            pipeline = client.pipeline()
+            pipeline.hdel(FILES_KEY, *removed)
+            pipeline.zrem(LRU_KEY, *removed)
+            pipeline.execute()
+        return list(removed.values())
+
+    def stats(self):
+        """
+        返回各存储中的文件数和总大小。
+        """
+        result = {}
+        for member, entry, accessed_at in self._entries(self._client()):
+            store = result.setdefault(entry["store"], {"files": 0, "bytes": 0})
+            store["files"] += 1
+            store["bytes"] += entry["size"]
+        return result
+
+
+storage_index = StorageIndex(os.getenv("REDISCLOUD_URL"))
+
+
+def save_upload(stream, suffix=""):
+    """
+    把上传的文件流写入 blob_store 并登记，返回存储键。
+    """
+    reader = _CountingReader(stream)
+    key = blob_store.put_stream(reader, suffix)
+    storage_index.record(UPLOADS, key, reader.size)
+    return key
+
+
+def save_artifact(path):
+    """
+    把生成的报告或打包文件写入 report_store 并登记，返回存储键。
+    """
+    key = put_file(path, store=report_store)
+    storage_index.record(REPORTS, key, os.path.getsize(path))
+    return key
+
+
+def touch_artifact(key):
+    """
+    下载时刷新访问时间，常被下载的报告保留得更久。
+    """
+    storage_index.touch(REPORTS, key)
+
+
+def sweep(ttl=STORAGE_TTL, quota_bytes=STORAGE_QUOTA_BYTES):
+    """
+    删除过期和超出配额的文件，返回删除的文件数。
+    """
+    removed = storage_index.expired(ttl, quota_bytes)
+    for store, key in removed:
+        try:
+            STORES[store].delete(key)
+        except Exception as e:
+            logger.warning(f"无法删除存储文件 {store}/{key}: {e}")
+    # 报告缓存中指向已删除报告的条目一并作废
+    report_cache.discard([key for store, key in removed if store == REPORTS])
+    if removed:
+        logger.info(f"存储清理：删除了 {len(removed)} 个文件")
+    return len(removed)
+
+
+@shared_task
+def sweep_storage_task():
+    """
+    后台定时清理存储，由 Celery beat 按 STORAGE_SWEEP_INTERVAL 调度。
+    """
+    return sweep()